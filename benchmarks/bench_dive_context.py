@@ -0,0 +1,80 @@
+"""
+Compare loading the rows for each dive with the per dive queries
+against GDiveLogDB.dive_contexts.
+
+  python benchmarks/bench_dive_context.py [--dives N] [--samples N]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import shutil
+from optparse import OptionParser
+
+import sqlalchemy.event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdivelog.db import GDiveLogDB
+from gdivelog.prefs import GDiveLogPreferences
+from gdivelog2uddf import make_parser
+from synthetic import make_logbook, make_preferences
+
+
+def per_dive(db, dives):
+    for dive in dives:
+        for dive_tank in db.dive_tanks(diveid=dive.dive_id):
+            db.tank_by_id(dive_tank.tank_id)
+        list(db.buddies(diveid=dive.dive_id))
+        list(db.equipment(diveid=dive.dive_id))
+        list(db.samples(dive.dive_id))
+
+
+def batched(db, dives):
+    for context in db.dive_contexts(dives):
+        pass
+
+
+def run(db, dives, loader):
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    engine = db.session.bind
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+    start = time.time()
+    loader(db, dives)
+    elapsed = time.time() - start
+    sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+    # Start from an empty identity map for each run.
+    db.session.expunge_all()
+    return queries[0], elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--dives', type='int', default=1000)
+    parser.add_option('--samples', type='int', default=200)
+    (options, args) = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=options.dives, samples=options.samples)
+        make_preferences(preferences)
+        print '%d dives, %d samples per dive' % (options.dives, options.samples)
+
+        options, args = make_parser().parse_args(['-i', logbook, '-c', preferences, '--no-db-cache'])
+        db = GDiveLogDB(options, GDiveLogPreferences(options))
+        dives = list(db.dives())
+
+        for name, loader in (('per dive', per_dive), ('dive_contexts', batched)):
+            queries, elapsed = run(db, dives, loader)
+            print '%-14s %8d queries %8.2fs' % (name, queries, elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
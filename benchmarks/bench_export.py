@@ -0,0 +1,192 @@
+"""
+Benchmark an export of a synthetic logbook stage by stage.
+
+  python benchmarks/bench_export.py [--dives N] [--samples N] [--tanks N]
+      [--buddies N] [--site-depth N] [--json FILE] [--compare FILE]
+
+Each case runs in a fresh process and times the stages;
+
+  decompress -- opening the logbook, without the decompression cache,
+                so including creating the indexes (see logbook.INDEXES)
+  query -- planning the segments and loading every dive's rows
+  build -- building the documents (~0 for --stream, where the dives are
+           built while they're written, and most of the dives are
+           rendered while they're written with the dive cache)
+  serialize -- writing the documents to a byte counting sink
+
+along with the peak RSS of the process and the size of the output.
+--json writes the results with the commit they were measured at,
+--compare prints them against the results from an earlier --json.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BASEDIR)
+
+from gdivelog.logbook import open_logbook
+from gdivelog.prefs import GDiveLogPreferences
+from gdivelog.uddf import GDiveLogUDDF
+from gdivelog.udcf import GDiveLogUDCF
+from gdivelog2uddf import make_parser, write_doc
+from synthetic import make_logbook, make_preferences
+
+
+# name -> extra gdivelog2uddf options
+CASES = [
+    ('uddf', []),
+    ('uddf-pretty', ['--pretty']),
+    ('uddf-stream', ['--stream']),
+    ('uddf-sqlalchemy', ['--backend', 'sqlalchemy']),
+    ('udcf', ['--udcf']),
+    ('udcf-stream', ['--udcf', '--stream']),
+    # The other cases don't use the dive cache. These run one after the
+    # other with the same one, the first filling it and the second
+    # writing every dive from it.
+    ('uddf-cold', ['--dive-cache-dir', '{workdir}/dives']),
+    ('uddf-warm', ['--dive-cache-dir', '{workdir}/dives']),
+]
+
+STAGES = ('decompress', 'query', 'build', 'serialize')
+
+
+class _CountingSink(object):
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+
+def _run_case(logbook, preferences, argv, results):
+    options, args = make_parser().parse_args(['-i', logbook, '-c', preferences, '--no-db-cache', '--no-cache'] + argv)
+    result = {}
+
+    start = time.time()
+    preferences = GDiveLogPreferences(options)
+    db = open_logbook(options, preferences)
+    result['decompress'] = time.time() - start
+
+    start = time.time()
+    dives = list(db.dives(orderby='datetime'))
+    for context in db.dive_contexts(dives):
+        pass
+    result['query'] = time.time() - start
+    if options.backend == 'sqlalchemy':
+        db.session.expunge_all()
+
+    if options.udcf:
+        xml = GDiveLogUDCF(db, options, preferences, args)
+    else:
+        xml = GDiveLogUDDF(db, options, preferences, args)
+    result['build'] = result['serialize'] = 0.0
+    sink = _CountingSink()
+    docs = xml.iter_dives()
+    while True:
+        start = time.time()
+        try:
+            doc = docs.next()
+        except StopIteration:
+            break
+        result['build'] += time.time() - start
+        start = time.time()
+        write_doc(sink, doc, options.prettyprint)
+        result['serialize'] += time.time() - start
+        del doc
+
+    result['bytes'] = sink.bytes
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(result)
+
+
+def run_case(logbook, preferences, argv):
+    '''Run a case in its own process, so the peak RSS is its own'''
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(logbook, preferences, argv, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASEDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    header = '%-12s' % 'case' + ''.join('%12s' % stage for stage in STAGES) + '%12s%12s' % ('peak MB', 'output MB')
+    print header
+    for name, argv in CASES:
+        if name not in results['cases']:
+            continue
+        result = results['cases'][name]
+        values = [result[stage] for stage in STAGES] + [result['peak_rss_kb'] / 1024.0, result['bytes'] / 1024.0 / 1024.0]
+        print '%-12s' % name + ''.join('%12.3f' % value for value in values)
+        if baseline and name in baseline['cases']:
+            old = baseline['cases'][name]
+            olds = [old[stage] for stage in STAGES] + [old['peak_rss_kb'] / 1024.0, old['bytes'] / 1024.0 / 1024.0]
+            ratios = ['%11.2fx' % (value / oldvalue) if oldvalue else '%12s' % '-' for value, oldvalue in zip(values, olds)]
+            print '%-12s' % ('  vs %s' % (baseline.get('commit') or 'baseline')) + ''.join(ratios)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--dives', type='int', default=1000)
+    parser.add_option('--samples', type='int', default=200, help='Samples per dive')
+    parser.add_option('--tanks', type='int', default=2, help='Max tanks per dive')
+    parser.add_option('--buddies', type='int', default=10)
+    parser.add_option('--site-depth', dest='site_depth', type='int', default=3)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--case', dest='cases', action='append', default=None, help='Only run this case, may be repeated')
+    parser.add_option('--json', dest='json', default=None, help='Write the results to this file')
+    parser.add_option('--compare', dest='compare', default=None, help='Compare with the results in this file')
+    (options, args) = parser.parse_args()
+
+    params = {'dives': options.dives, 'samples': options.samples, 'tanks': options.tanks,
+              'buddies': options.buddies, 'site_depth': options.site_depth, 'seed': options.seed}
+    results = {'commit': _commit(), 'python': platform.python_version(), 'params': params, 'cases': {}}
+
+    workdir = tempfile.mkdtemp()
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=options.dives, samples=options.samples, tanks=options.tanks,
+                     buddies=options.buddies, site_depth=options.site_depth, seed=options.seed)
+        make_preferences(preferences)
+        for name, argv in CASES:
+            if options.cases and name not in options.cases:
+                continue
+            results['cases'][name] = run_case(logbook, preferences, [arg.format(workdir=workdir) for arg in argv])
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as data:
+            baseline = json.load(data)
+        if baseline['params'] != params:
+            print >> sys.stderr, 'Warning: %s was measured with %r' % (options.compare, baseline['params'])
+
+    print 'commit %s, %r' % (results['commit'], params)
+    print_results(results, baseline)
+
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
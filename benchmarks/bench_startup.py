@@ -0,0 +1,140 @@
+"""
+Benchmark the startup of small exports, as when gdivelog2uddf.py is
+called from scripts once per dive.
+
+  python benchmarks/bench_startup.py [--dives N] [--runs N] [--json FILE] [--compare FILE]
+
+Each case runs gdivelog2uddf.py in a fresh interpreter to export a
+single dive by number from a synthetic logbook, with the decompression
+cache warmed up first, and records the median of;
+
+  import -- importing gdivelog2uddf, measured in the child
+  first byte -- from starting the process to the first byte of output
+  total -- from starting the process until it exits
+
+--json writes the results with the commit they were measured at,
+--compare prints them against the results from an earlier --json.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+
+BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(BASEDIR, 'gdivelog2uddf.py')
+sys.path.insert(0, BASEDIR)
+
+from synthetic import make_logbook, make_preferences
+
+
+# name -> extra gdivelog2uddf options
+CASES = [
+    ('uddf', []),
+    ('uddf-sqlalchemy', ['--backend', 'sqlalchemy']),
+    ('udcf', ['--udcf']),
+]
+
+STAGES = ('import', 'first byte', 'total')
+
+_IMPORT = 'import sys, time; start = time.time(); sys.path.insert(0, %r); import gdivelog2uddf; print time.time() - start'
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def _first_byte(argv):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, SCRIPT] + argv, stdout=subprocess.PIPE)
+    process.stdout.read(1)
+    first = time.time() - start
+    process.stdout.read()
+    process.wait()
+    if process.returncode:
+        raise RuntimeError('%r failed with %d' % (argv, process.returncode))
+    return first, time.time() - start
+
+
+def run_case(argv, runs):
+    imports, firsts, totals = [], [], []
+    for run in range(runs):
+        imports.append(float(subprocess.check_output([sys.executable, '-c', _IMPORT % BASEDIR])))
+        first, total = _first_byte(argv)
+        firsts.append(first)
+        totals.append(total)
+    return {'import': _median(imports), 'first byte': _median(firsts), 'total': _median(totals)}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASEDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print '%-16s' % 'case' + ''.join('%12s' % stage for stage in STAGES)
+    for name, argv in CASES:
+        if name not in results['cases']:
+            continue
+        values = [results['cases'][name][stage] * 1000 for stage in STAGES]
+        print '%-16s' % name + ''.join('%10.1fms' % value for value in values)
+        if baseline and name in baseline['cases']:
+            olds = [baseline['cases'][name][stage] * 1000 for stage in STAGES]
+            ratios = ['%11.2fx' % (value / oldvalue) if oldvalue else '%12s' % '-' for value, oldvalue in zip(values, olds)]
+            print '%-16s' % ('  vs %s' % (baseline.get('commit') or 'baseline')) + ''.join(ratios)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--dives', type='int', default=1000)
+    parser.add_option('--samples', type='int', default=200, help='Samples per dive')
+    parser.add_option('--runs', type='int', default=7, help='Runs per case, the median is reported')
+    parser.add_option('--case', dest='cases', action='append', default=None, help='Only run this case, may be repeated')
+    parser.add_option('--json', dest='json', default=None, help='Write the results to this file')
+    parser.add_option('--compare', dest='compare', default=None, help='Compare with the results in this file')
+    (options, args) = parser.parse_args()
+
+    params = {'dives': options.dives, 'samples': options.samples}
+    results = {'commit': _commit(), 'python': platform.python_version(), 'params': params, 'cases': {}}
+
+    workdir = tempfile.mkdtemp()
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=options.dives, samples=options.samples)
+        make_preferences(preferences)
+        common = ['-i', logbook, '-c', preferences, '--db-cache-dir', os.path.join(workdir, 'cache'), '--no-cache']
+        # Warm up the decompression cache, a script calling us repeatedly would have it.
+        _first_byte(common + [str(options.dives / 2)])
+        for name, argv in CASES:
+            if options.cases and name not in options.cases:
+                continue
+            results['cases'][name] = run_case(common + argv + [str(options.dives / 2)], options.runs)
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as data:
+            baseline = json.load(data)
+        if baseline['params'] != params:
+            print >> sys.stderr, 'Warning: %s was measured with %r' % (options.compare, baseline['params'])
+
+    print 'commit %s, %r' % (results['commit'], params)
+    print_results(results, baseline)
+
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Check that every --backend gives the same output for a synthetic logbook.
+
+  python benchmarks/check_backends.py [--dives N] [--samples N]
+
+Exports the logbook with each backend for a set of option
+combinations and compares the bytes, apart from the generator's
+timestamp. Exits with 1 if any differ.
+"""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdivelog.logbook import BACKENDS, open_logbook
+from gdivelog.prefs import GDiveLogPreferences
+from gdivelog.uddf import GDiveLogUDDF
+from gdivelog.udcf import GDiveLogUDCF
+from gdivelog2uddf import make_parser, write_doc
+from synthetic import make_logbook, make_preferences
+
+
+OPTIONS = [
+    [],
+    ['--pretty'],
+    ['--stream'],
+    ['--segment', '50', '--trip-threshold', '3'],
+    ['--max-samples', '20'],
+    ['--udcf'],
+]
+
+_GENERATED = re.compile(r'(<generator>.*?<datetime>)[^<]*(</datetime>)', re.S)
+
+
+def export(logbook, preferences, argv):
+    options, args = make_parser().parse_args(['-i', logbook, '-c', preferences, '--no-db-cache', '--no-cache'] + argv)
+    preferences = GDiveLogPreferences(options)
+    db = open_logbook(options, preferences)
+    if options.udcf:
+        xml = GDiveLogUDCF(db, options, preferences, args)
+    else:
+        xml = GDiveLogUDDF(db, options, preferences, args)
+    out = StringIO()
+    for doc in xml.iter_dives():
+        write_doc(out, doc, options.prettyprint)
+    return _GENERATED.sub(r'\1\2', out.getvalue())
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--dives', type='int', default=300)
+    parser.add_option('--samples', type='int', default=50)
+    (options, args) = parser.parse_args()
+
+    failed = False
+    workdir = tempfile.mkdtemp()
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=options.dives, samples=options.samples)
+        make_preferences(preferences)
+        for argv in OPTIONS:
+            outputs = dict((backend, export(logbook, preferences, argv + ['--backend', backend])) for backend in sorted(BACKENDS))
+            same = len(set(outputs.values())) == 1
+            failed = failed or not same
+            print '%-40s %s' % (' '.join(argv) or '(defaults)', same and 'same' or 'DIFFERENT')
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
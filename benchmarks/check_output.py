@@ -0,0 +1,124 @@
+"""
+Check the output in cases that have gone wrong before; that the faster
+ways elements are written give what the original minidom code gave,
+byte for byte, that logbooks with odd rows export cleanly and that
+segments aren't split in the middle of repetitive dives.
+
+  python benchmarks/check_output.py
+
+Runs each check and prints whether it passed. Exits with 1 if any failed.
+"""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import xml.dom.minidom
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdivelog.logbook import BACKENDS, Samples
+from gdivelog.uddf import _WaypointBlock
+from gdivelog.utils import celcius_to_kelvin, xml_add
+from check_backends import export
+from synthetic import make_logbook, make_preferences
+
+
+def _written(node):
+    out = StringIO()
+    node.writexml(out, '', '  ', '\n')
+    return out.getvalue()
+
+
+def check_waypoints():
+    '''_WaypointBlock against a <waypoint> per sample made with xml_add'''
+    samples = Samples()
+    # 13.2C is 286.34999999999997K, written as 286.35 by xml_add.
+    for time, depth, temperature in ((0, 0.0, 13.2), (20, 3.7, 12.85), (40, 10.25, 0.0), (60, 12.5, -273.15)):
+        samples.append(time, depth, temperature)
+    mix_switch_times = [(0, 'mix_air'), (30, 'mix_32')]
+
+    top = xml.dom.minidom.Document()
+    expected = top.createElement('samples')
+    switches = list(mix_switch_times)
+    for time, depth, temperature in zip(samples.times, samples.depths, samples.temperatures):
+        waypoint = xml_add(top, expected, 'waypoint', subfields={'divetime': time, 'depth': depth})
+        if switches and time >= switches[0][0]:
+            xml_add(top, waypoint, 'switchmix', attr={'ref': switches.pop(0)[1]})
+        k = celcius_to_kelvin(temperature)
+        if k > 0:
+            xml_add(top, waypoint, 'temperature', k)
+
+    block = top.createElement('samples')
+    block.appendChild(_WaypointBlock(samples, mix_switch_times))
+    return _written(expected) == _written(block)
+
+
+def check_siteless_dives():
+    """
+    Dives with site_id 0 and NULL export without warnings, with trips,
+    as UDCF and with a site selection, the same with each backend.
+    """
+    workdir = tempfile.mkdtemp()
+    stderr = sys.stderr
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=30, samples=5, siteless=3)
+        make_preferences(preferences)
+        sys.stderr = StringIO()
+        for argv in (['--trip-threshold', '3'], ['--udcf'], ['--select', 'site!=Site*', '--trip-threshold', '3']):
+            outputs = set(export(logbook, preferences, argv + ['--backend', backend]) for backend in sorted(BACKENDS))
+            if len(outputs) != 1:
+                return False
+        return sys.stderr.getvalue() == ''
+    finally:
+        sys.stderr = stderr
+        shutil.rmtree(workdir)
+
+
+def check_segment_boundaries():
+    """
+    With --segment every document starts with a new repetition group,
+    no repetitive dive is separated from the dive before it, and UDCF
+    exports are split into documents with the same dives.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        logbook = os.path.join(workdir, 'logbook')
+        preferences = os.path.join(workdir, 'preferences')
+        make_logbook(logbook, dives=60, samples=5)
+        make_preferences(preferences)
+        documents = export(logbook, preferences, ['--segment', '10']).split('<?xml')[1:]
+        udcf_documents = export(logbook, preferences, ['--segment', '10', '--udcf']).split('<?xml')[1:]
+        if len(documents) < 2:
+            return False
+        for document in documents:
+            first = re.search(r'<surfaceintervalbeforedive>(<\w+)', document)
+            if first is None or first.group(1) != '<infinity':
+                return False
+        return [document.count('<dive ') for document in documents] == [document.count('<dive>') for document in udcf_documents]
+    finally:
+        shutil.rmtree(workdir)
+
+
+CHECKS = [
+    ('waypoints', check_waypoints),
+    ('siteless dives', check_siteless_dives),
+    ('segment boundaries', check_segment_boundaries),
+]
+
+
+def main():
+    failed = False
+    for name, check in CHECKS:
+        passed = check()
+        failed = failed or not passed
+        print '%-40s %s' % (name, passed and 'ok' or 'FAILED')
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
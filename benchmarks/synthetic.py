@@ -0,0 +1,136 @@
+"""
+Generate synthetic gdivelog logbooks for benchmarking.
+
+The logbook is a bz2 compressed sqlite db with the tables mapped by
+GDiveLogDB, the preferences file has just the fields
+GDiveLogPreferences reads.
+"""
+
+import os
+import bz2
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+
+__all__ = ['make_logbook', 'make_preferences']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+SCHEMA = '''
+CREATE TABLE Site (site_id INTEGER PRIMARY KEY, site_parent_id INTEGER, site_name TEXT, site_notes TEXT);
+CREATE TABLE Dive (dive_id INTEGER PRIMARY KEY, dive_number INTEGER, dive_datetime TEXT, dive_duration INTEGER,
+                   dive_maxdepth REAL, dive_mintemp REAL, dive_maxtemp REAL, dive_notes TEXT, site_id INTEGER,
+                   dive_visibility REAL, dive_weight REAL);
+CREATE TABLE Profile (dive_id INTEGER, profile_time INTEGER, profile_depth REAL, profile_temperature REAL);
+CREATE TABLE Buddy (buddy_id INTEGER PRIMARY KEY, buddy_name TEXT, buddy_notes TEXT);
+CREATE TABLE Dive_Buddy (dive_id INTEGER, buddy_id INTEGER);
+CREATE TABLE Equipment (equipment_id INTEGER PRIMARY KEY, equipment_name TEXT, equipment_notes TEXT);
+CREATE TABLE Dive_Equipment (equipment_id INTEGER, dive_id INTEGER);
+CREATE TABLE Tank (tank_id INTEGER PRIMARY KEY, tank_name TEXT, tank_volume REAL, tank_wp REAL, tank_notes TEXT);
+CREATE TABLE Dive_Tank (dive_tank_id INTEGER PRIMARY KEY, dive_id INTEGER, tank_id INTEGER, dive_tank_avg_depth REAL,
+                        dive_tank_O2 REAL, dive_tank_He REAL, dive_tank_stime INTEGER, dive_tank_etime INTEGER,
+                        dive_tank_spressure REAL, dive_tank_epressure REAL);
+'''
+
+
+def _add_sites(db, rnd, parent_id, level, depth, fanout, leaves):
+    for idx in range(fanout):
+        notes = rnd.choice([None, u'Notes for site & level %d\n\nSecond paragraph' % level])
+        cursor = db.execute('INSERT INTO Site (site_parent_id, site_name, site_notes) VALUES (?, ?, ?)',
+                            (parent_id, u'Site %d.%d' % (level, idx), notes))
+        if level + 1 < depth:
+            _add_sites(db, rnd, cursor.lastrowid, level + 1, depth, fanout, leaves)
+        else:
+            leaves.append(cursor.lastrowid)
+
+
+def make_logbook(path, dives=100, samples=200, tanks=2, buddies=10, equipment=10, site_depth=3, site_fanout=4, seed=0,
+                 siteless=0):
+    """
+    Write a synthetic bz2 compressed gdivelog logbook to path.
+
+    Args;
+       dives -- number of dives
+       samples -- number of profile samples per dive
+       tanks -- max number of tanks used per dive
+       buddies -- number of buddies, each dive has up to 3
+       equipment -- number of pieces of equipment, each dive has up to 5
+       site_depth -- number of levels in the site tree
+       site_fanout -- number of children per site
+       seed -- random seed, the same arguments give the same logbook
+       siteless -- if set, every siteless'th dive has no site, every
+          other one of those with site_id 0 and the others NULL.
+    """
+    rnd = random.Random(seed)
+    raw = tempfile.NamedTemporaryFile(delete=False)
+    raw.close()
+    db = sqlite3.connect(raw.name)
+    db.executescript(SCHEMA)
+
+    leaves = []
+    _add_sites(db, rnd, 0, 0, site_depth, site_fanout, leaves)
+
+    for buddy_id in range(1, buddies + 1):
+        db.execute('INSERT INTO Buddy VALUES (?, ?, ?)', (buddy_id, u'Buddy %d Surname' % buddy_id, rnd.choice([None, u'Buddy notes'])))
+    for equipment_id in range(1, equipment + 1):
+        db.execute('INSERT INTO Equipment VALUES (?, ?, ?)', (equipment_id, u'Equipment %d' % equipment_id, rnd.choice([None, u'Equipment notes'])))
+    tank_ids = range(1, max(tanks, 1) + 1)
+    for tank_id in tank_ids:
+        db.execute('INSERT INTO Tank VALUES (?, ?, ?, ?, ?)', (tank_id, u'Tank %d' % tank_id, rnd.choice([10.0, 12.0, 15.0]), 232.0, None))
+
+    divetime = datetime(2000, 1, 1, 9, 0, 0)
+    for number in range(1, dives + 1):
+        # Trips of a handful of dives, separated by more than SI_INF.
+        if rnd.random() < 0.15:
+            divetime += timedelta(days=rnd.randint(6, 60))
+        else:
+            divetime += timedelta(hours=rnd.randint(2, 26))
+        duration = samples * 10
+        cursor = db.execute('INSERT INTO Dive (dive_number, dive_datetime, dive_duration, dive_maxdepth, dive_mintemp, dive_maxtemp, '
+                            'dive_notes, site_id, dive_visibility, dive_weight) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (number, divetime.strftime('%Y-%m-%d %H:%M:%S'), duration, round(rnd.uniform(5, 40), 1),
+                             rnd.choice([0.0, 14.0, 22.0]), 26.0, rnd.choice([None, u'Dive notes\n\nMore notes']),
+                             rnd.choice(leaves), 10.0, rnd.choice([0.0, 4.0])))
+        dive_id = cursor.lastrowid
+        if siteless and number % siteless == 0:
+            db.execute('UPDATE Dive SET site_id = ? WHERE dive_id = ?', ((0, None)[number / siteless % 2], dive_id))
+        db.executemany('INSERT INTO Profile VALUES (?, ?, ?, ?)',
+                       [(dive_id, idx * 10, round(rnd.uniform(0, 40), 2), round(rnd.uniform(10, 28), 1)) for idx in range(samples)])
+        for idx in range(rnd.randint(min(tanks, 1), tanks)):
+            o2, he = rnd.choice([(21.0, 0.0), (32.0, 0.0), (36.0, 0.0), (50.0, 0.0), (21.0, 35.0)])
+            db.execute('INSERT INTO Dive_Tank (dive_id, tank_id, dive_tank_avg_depth, dive_tank_O2, dive_tank_He, dive_tank_stime, '
+                       'dive_tank_etime, dive_tank_spressure, dive_tank_epressure) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (dive_id, rnd.choice(tank_ids), 12.0, o2, he, idx * duration / max(tanks, 1), duration, 200.0, 50.0))
+        for buddy_id in rnd.sample(range(1, buddies + 1), min(buddies, rnd.randint(0, 3))):
+            db.execute('INSERT INTO Dive_Buddy VALUES (?, ?)', (dive_id, buddy_id))
+        for equipment_id in rnd.sample(range(1, equipment + 1), min(equipment, rnd.randint(0, 5))):
+            db.execute('INSERT INTO Dive_Equipment VALUES (?, ?)', (equipment_id, dive_id))
+    db.commit()
+    db.close()
+
+    compressed = bz2.BZ2File(path, 'w')
+    with open(raw.name, 'rb') as data:
+        compressed.write(data.read())
+    compressed.close()
+    os.unlink(raw.name)
+
+
+def make_preferences(path, depth_unit='m', site_name_seperator='/'):
+    """
+    Write a gdivelog preferences file to path. See GDiveLogPreferences for the layout.
+    """
+    data = bytearray(112)
+    if depth_unit == 'm':
+        data[0:6] = 'mckbl\0'
+    else:
+        data[0:6] = 'fflpc\0'
+    data[0140:0140 + len(site_name_seperator)] = site_name_seperator
+    with open(path, 'wb') as preferences:
+        preferences.write(data)
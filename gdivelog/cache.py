@@ -0,0 +1,209 @@
+"""
+Cache of decompressed gdivelog databases
+"""
+
+import os
+import re
+import sys
+import bz2
+import json
+import stat
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+__all__ = ['DecompressionCache', 'decompress']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+BLOCK_SIZE = 1024 * 1024
+
+# The names of the decompressed copies, the only files evicted.
+_COPY = re.compile(r'^[0-9a-f]{40}(\.[^.]+)?\.db$')
+
+
+def decompress(src, dst):
+    '''Decompress the bz2 file named src into the file object dst, a block at a time'''
+    compressed = bz2.BZ2File(src, 'rb')
+    try:
+        shutil.copyfileobj(compressed, dst, BLOCK_SIZE)
+    finally:
+        compressed.close()
+    dst.flush()
+
+
+@contextmanager
+def _locked(path):
+    '''Hold an exclusive lock on the file path, created if needed, for the block'''
+    with open(path, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as data:
+        for block in iter(lambda: data.read(BLOCK_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DecompressionCache(object):
+    """
+    Content addressed cache of decompressed logbooks.
+
+    Each decompressed database is stored as <sha1 of the bz2 file>.db,
+    or <sha1>.<prepare_key>.db.
+    The index file remembers the size, mtime and sha1 of the logbooks
+    seen, so an unchanged logbook isn't even rehashed. Entries are
+    touched when used, and the least recently used ones are removed
+    when the cache grows beyond max_size bytes.
+
+    Several processes can share a cache, eg. a directory in /dev/shm
+    for cron jobs and --jobs workers. The index is updated under a
+    lock, and each database is decompressed under a lock of its own,
+    so a process wanting a database another is decompressing waits for
+    it instead of decompressing it again. A database is prepared and
+    made read only before it's renamed into place, after that it's
+    never written, so the processes mapping it share its pages.
+    """
+
+    INDEX = 'index.json'
+    LOCK = 'index.lock'
+
+    def __init__(self, directory, max_size, verbose=False, prepare=None, prepare_key=None):
+        """
+        Args;
+           directory -- created if it doesn't exist.
+           max_size -- in bytes.
+           verbose -- report what's done to stderr.
+           prepare -- function called with the file name of a newly
+              decompressed database, before other processes can see
+              it, eg. to index it.
+           prepare_key -- identifies what prepare does, so copies
+              prepared differently, eg. by another version, aren't used.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.verbose = verbose
+        self.prepare = prepare
+        self.prepare_key = prepare_key
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def _log(self, message):
+        if self.verbose:
+            print >> sys.stderr, message
+
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, DecompressionCache.INDEX)) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _save_index(self, index):
+        # Write and rename, so a concurrent run never sees half an index.
+        fd, name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump(index, out)
+        os.rename(name, os.path.join(self.directory, DecompressionCache.INDEX))
+
+
+    def get(self, src):
+        """
+        Returns the name of the decompressed copy of the bz2 file src,
+        decompressing it into the cache if needed.
+        """
+        src = os.path.abspath(src)
+        src_stat = os.stat(src)
+        entry = self._load_index().get(src)
+        if entry and entry['size'] == src_stat.st_size and entry['mtime'] == src_stat.st_mtime:
+            digest = entry['sha1']
+        else:
+            digest = _file_digest(src)
+            with _locked(os.path.join(self.directory, DecompressionCache.LOCK)):
+                # Re-read, another process may have added a logbook since.
+                index = self._load_index()
+                index[src] = {'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'sha1': digest}
+                self._save_index(index)
+
+        if self.prepare_key:
+            digest = '%s.%s' % (digest, self.prepare_key)
+        name = os.path.join(self.directory, digest + '.db')
+        if os.path.exists(name):
+            self._log('Using cached %s for %s' % (name, src))
+            try:
+                os.utime(name, None)
+            except OSError:
+                # Another user's copy, it just won't count as recently used.
+                pass
+        else:
+            with _locked(name + '.lock'):
+                if os.path.exists(name):
+                    self._log('Using %s for %s, decompressed by another process' % (name, src))
+                else:
+                    self._decompress(src, name)
+        self._evict(keep=name)
+        return name
+
+
+    def _decompress(self, src, name):
+        '''Decompress src into name, holding its lock'''
+        self._log('Decompressing %s into %s' % (src, name))
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                decompress(src, out)
+            if self.prepare:
+                self.prepare(tmp)
+            # Readable by whoever can read the directory, and by nobody writable.
+            mode = stat.S_IMODE(os.stat(self.directory).st_mode) & (stat.S_IRGRP | stat.S_IROTH)
+            os.chmod(tmp, stat.S_IRUSR | mode)
+            os.rename(tmp, name)
+        except:
+            os.unlink(tmp)
+            raise
+
+
+    def _evict(self, keep):
+        """
+        Remove the least recently used databases until the cache fits in max_size.
+        """
+        entries = []
+        for fname in os.listdir(self.directory):
+            if _COPY.match(fname):
+                path = os.path.join(self.directory, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            self._log('Evicting %s' % path)
+            for fname in (path, path + '.lock'):
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,120 @@
+"""
+Compressed output for --compress, compressed as it's written
+"""
+
+import bz2
+import zlib
+
+
+__all__ = ['COMPRESSIONS', 'check_compression', 'compression_for', 'CompressedFile', 'open_output']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+# Writes are compressed in blocks of about this size.
+BLOCK_SIZE = 64 * 1024
+
+
+def _lzma():
+    '''The lzma module, which Python 2 needs backports.lzma for'''
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError('xz compression requires the backports.lzma module')
+    return lzma
+
+
+def _compressor(compression):
+    if compression == 'gz':
+        # wbits 16 + 15 writes a gzip header, with no name and mtime 0.
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Compressor(9)
+    if compression == 'xz':
+        return _lzma().LZMACompressor()
+    raise ValueError('Unknown compression %r' % compression)
+
+
+def check_compression(compression):
+    '''Raises ImportError if compression isn't available'''
+    if compression == 'xz':
+        _lzma()
+
+
+def compression_for(fname):
+    '''The compression given by fname's extension, or None'''
+    extension = fname.rsplit('.', 1)[-1]
+    if extension in COMPRESSIONS and extension != fname:
+        return extension
+    return None
+
+
+class CompressedFile(object):
+    """
+    File like object compressing what's written to it onto out. The
+    output is the same as gzip, bzip2 or xz would give for the whole
+    file, so there's no need for a second pass.
+    """
+
+    def __init__(self, out, compression, close_out=True):
+        """
+        Args;
+           out -- file like object to write the compressed data to.
+           compression -- one of COMPRESSIONS.
+           close_out -- close out on close, or just flush it (for stdout).
+        """
+        self.out = out
+        self.compressor = _compressor(compression)
+        self.close_out = close_out
+        self.buffer = []
+        self.size = 0
+
+
+    def _compress(self):
+        data = self.compressor.compress(''.join(self.buffer))
+        if data:
+            self.out.write(data)
+        self.buffer = []
+        self.size = 0
+
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= BLOCK_SIZE:
+            self._compress()
+
+
+    def flush(self):
+        self.out.flush()
+
+
+    def close(self):
+        self._compress()
+        self.out.write(self.compressor.flush())
+        if self.close_out:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+def open_output(fname, compression=None):
+    """
+    Open fname for writing, compressed with compression or what its
+    extension says if that's None.
+    """
+    if compression is None:
+        compression = compression_for(fname)
+    out = open(fname, 'wb')
+    if compression:
+        return CompressedFile(out, compression)
+    return out
@@ -2,14 +2,16 @@
 SQLAlchemy ORM for gdivelog's sqlite db
 """
 
-import tempfile
-import bz2
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.ext.declarative
 from sqlalchemy import Table, Column, Integer, Float, String, MetaData, ForeignKey
 
+from gdivelog.logbook import Logbook, DiveContext, Samples, PRAGMAS
+from gdivelog.instrument import NULL_INSTRUMENTATION
 
-__all__ = ['GDiveLogDB']
+
+__all__ = ['GDiveLogDB', 'DiveContext', 'Samples']
 __author__ = "Eskil Heyn <eskil@eskil.org>"
 __maintainer__ = "Eskil Olsen <eskil@eskil.org>"
 __copyright__ = "Copyright 2011"
@@ -18,25 +20,37 @@ __version__ = "1.0"
 __status__ = "Production"
 
 
-class GDiveLogDB(object):
+def _set_pragmas(dbapi_connection, connection_record):
+    # The same settings as GDiveLogSQLite. In autocommit mode for the
+    # temporary tables and indexes (see Logbook._writable), as sqlite3
+    # otherwise commits before a CREATE, resetting the queries in progress.
+    dbapi_connection.isolation_level = None
+    for pragma in PRAGMAS:
+        dbapi_connection.execute(pragma)
+
+
+class GDiveLogDB(Logbook):
     """
     SQLAlchemy ORM for gdivelog's sqlite db
     """
 
     Base = sqlalchemy.ext.declarative.declarative_base()
 
-    def __init__(self, options, preferences):
+    def __init__(self, options, preferences, filename=None, instrument=NULL_INSTRUMENTATION):
         """
-        """
-        self.preferences = preferences
-        self.bunzipped2 = tempfile.NamedTemporaryFile(delete=True)
-        for data in bz2.BZ2File(options.gdivelog_db):
-            self.bunzipped2.write(data)
-        self.bunzipped2.flush()
+        Opens the logbook in options.gdivelog_db, or if filename is
+        given the already decompressed database in that file.
 
-        engine = sqlalchemy.create_engine('sqlite:///%s' % self.bunzipped2.name, echo=options.verbose)
+        instrument is the Instrumentation to count queries and rows with.
+        """
+        Logbook.__init__(self, options, preferences, filename=filename, instrument=instrument)
+        engine = sqlalchemy.create_engine('sqlite:///%s' % self.filename, echo=options.verbose)
+        sqlalchemy.event.listen(engine, 'connect', _set_pragmas)
+        if instrument.enabled:
+            instrument.watch_engine(engine)
         Session = sqlalchemy.orm.sessionmaker(bind=engine)
         self.session = Session()
+        self._index_tables()
 
 
     class Site(Base):
@@ -122,9 +136,17 @@ class GDiveLogDB(object):
         dive_tank_epressure = Column(Float)
 
 
-    def dives(self, numbers=None, ids=None, orderby='number'):
+    def _selected(self, query, selection):
+        '''Filter query on the dives selection selects, see Logbook.selected'''
+        if selection is not None:
+            query = query.filter(sqlalchemy.text(self.selected(selection)))
+        return query
+
+
+    def dives(self, numbers=None, ids=None, orderby='number', selection=None):
         """
-        Generator to iterate across dives in the database. Optionally only iterate across the ones listed in numbers.
+        Generator to iterate across dives in the database. Optionally only iterate across the ones listed in numbers,
+        or ids, and the ones selection selects.
         """
         if numbers:
             query = self.session.query(GDiveLogDB.Dive).filter(GDiveLogDB.Dive.dive_number.in_(numbers)).order_by(GDiveLogDB.Dive.dive_number.asc())
@@ -137,11 +159,28 @@ class GDiveLogDB(object):
             query = query.order_by(GDiveLogDB.Dive.dive_number.asc())
         elif orderby == 'datetime':
             query = query.order_by(GDiveLogDB.Dive.dive_datetime.asc())
+        query = self._selected(query.order_by(GDiveLogDB.Dive.dive_id.asc()), selection)
 
-        for dive in query:
+        for dive in self._rows(query):
             yield dive
 
 
+    def dive_timeline(self, numbers=None, selection=None):
+        """
+        Generator yielding (dive_id, dive_datetime, site_id) for the
+        dives in numbers and selection, or all, in the order of
+        dives(orderby='datetime').
+        """
+        Dive = GDiveLogDB.Dive
+        query = self.session.query(Dive.dive_id, Dive.dive_datetime, Dive.site_id)
+        if numbers:
+            query = query.filter(Dive.dive_number.in_(numbers))
+        query = self._selected(query, selection)
+        query = query.order_by(Dive.dive_number.asc(), Dive.dive_datetime.asc(), Dive.dive_id.asc())
+        for row in self._rows(query):
+            yield tuple(row)
+
+
     def dive_by_id(self, diveid):
         return self.session.query(GDiveLogDB.Dive).filter(GDiveLogDB.Dive.dive_id == diveid).one()
 
@@ -155,7 +194,7 @@ class GDiveLogDB(object):
         else:
             query = self.session.query(GDiveLogDB.Equipment)
 
-        for equipment in query:
+        for equipment in self._rows(query):
             yield equipment
 
     def buddies(self, diveid=None):
@@ -164,18 +203,21 @@ class GDiveLogDB(object):
         Optionally list buddies for a particular dive.
         """
         if not diveid:
-            for buddy in self.session.query(GDiveLogDB.Buddy):
+            for buddy in self._rows(self.session.query(GDiveLogDB.Buddy)):
                 yield buddy
         else:
-            for buddy in self.session.query(GDiveLogDB.DiveBuddy).filter(GDiveLogDB.DiveBuddy.dive_id == diveid):
+            for buddy in self._rows(self.session.query(GDiveLogDB.DiveBuddy).filter(GDiveLogDB.DiveBuddy.dive_id == diveid)):
                 yield buddy
 
 
     def samples(self, diveid):
         """
-        Generator to iterate across waypoint samples for a dive
+        Generator to iterate across waypoint samples for a dive. The
+        rows are (profile_time, profile_depth, profile_temperature)
+        column tuples, not Profile objects.
         """
-        for sample in self.session.query(GDiveLogDB.Profile).filter(GDiveLogDB.Profile.dive_id == diveid).order_by(GDiveLogDB.Profile.profile_time.asc()):
+        query = self.session.query(GDiveLogDB.Profile.profile_time, GDiveLogDB.Profile.profile_depth, GDiveLogDB.Profile.profile_temperature)
+        for sample in self._rows(query.filter(GDiveLogDB.Profile.dive_id == diveid).order_by(GDiveLogDB.Profile.profile_time.asc())):
             yield sample
 
 
@@ -183,12 +225,81 @@ class GDiveLogDB(object):
         query = self.session.query(GDiveLogDB.DiveTank)
         if diveid:
             query = query.filter(GDiveLogDB.DiveTank.dive_id == diveid)
-        for dive_tank in query:
+        for dive_tank in self._rows(query):
             yield dive_tank
 
 
+    def dive_contexts(self, dives, window=None):
+        """
+        Generator yielding a DiveContext for each of the given dives, in
+        the same order.
+
+        Instead of querying per dive, the related rows are loaded with
+        one query per table for each window of dives. The tanks are
+        looked up from a single pass over the Tank table.
+        """
+        if window is None:
+            window = self.CONTEXT_WINDOW
+        tanks = dict((tank.tank_id, tank) for tank in self.tanks())
+
+        for start in range(0, len(dives), window):
+            contexts = [DiveContext(dive) for dive in dives[start:start + window]]
+            by_id = dict((context.dive.dive_id, context) for context in contexts)
+            ids = by_id.keys()
+
+            for dive_tank in self._rows(self.session.query(GDiveLogDB.DiveTank).filter(GDiveLogDB.DiveTank.dive_id.in_(ids))):
+                tank = tanks.get(dive_tank.tank_id)
+                if tank is None:
+                    tank = self.tank_by_id(dive_tank.tank_id)
+                by_id[dive_tank.dive_id].tanks.append((dive_tank, tank))
+            for buddy in self._rows(self.session.query(GDiveLogDB.DiveBuddy).filter(GDiveLogDB.DiveBuddy.dive_id.in_(ids))):
+                by_id[buddy.dive_id].buddies.append(buddy)
+            for equipment in self._rows(self.session.query(GDiveLogDB.DiveEquipment).filter(GDiveLogDB.DiveEquipment.dive_id.in_(ids))):
+                by_id[equipment.dive_id].equipment.append(equipment)
+            query = self.session.query(GDiveLogDB.Profile.dive_id, GDiveLogDB.Profile.profile_time, GDiveLogDB.Profile.profile_depth, GDiveLogDB.Profile.profile_temperature)
+            query = query.filter(GDiveLogDB.Profile.dive_id.in_(ids)).order_by(GDiveLogDB.Profile.dive_id.asc(), GDiveLogDB.Profile.profile_time.asc())
+            for dive_id, time, depth, temperature in self._rows(query):
+                by_id[dive_id].samples.append(time, depth, temperature)
+
+            for context in contexts:
+                yield context
+
+
+    def mixes(self, ids=None, selection=None):
+        """
+        Generator to iterate across the distinct (dive_tank_O2,
+        dive_tank_He) mixes in Dive_Tank, in the order they're first
+        used. Optionally only the mixes used by the dives with the
+        given ids, or the dives selection selects.
+        """
+        query = self.session.query(GDiveLogDB.DiveTank.dive_tank_O2, GDiveLogDB.DiveTank.dive_tank_He)
+        if ids is not None:
+            if not ids:
+                return
+            query = query.filter(sqlalchemy.text('Dive_Tank.dive_id IN %s' % self._id_set(ids)))
+        query = self._selected(query, selection)
+        query = query.group_by(GDiveLogDB.DiveTank.dive_tank_O2, GDiveLogDB.DiveTank.dive_tank_He)
+        query = query.order_by(sqlalchemy.func.min(GDiveLogDB.DiveTank.dive_tank_id))
+        for mix in self._rows(query):
+            yield mix
+
+
+    def _execute(self, sql):
+        return self.session.execute(sql)
+
+
+    def _dbapi(self):
+        return self.session.connection().connection.connection
+
+
+    def release(self):
+        Logbook.release(self)
+        # The session holds on to its connection, which sqlite won't let another thread use.
+        self.session.close()
+
+
     def tanks(self):
-        for tank in self.session.query(GDiveLogDB.Tank):
+        for tank in self._rows(self.session.query(GDiveLogDB.Tank)):
             yield tank
 
 
@@ -203,26 +314,5 @@ class GDiveLogDB(object):
         Note, the site entries themselves are just fragments of
         the entire site name. See site_name_list and site_name.
         """
-        for site in self.session.query(GDiveLogDB.Site):
+        for site in self._rows(self.session.query(GDiveLogDB.Site)):
             yield site
-
-
-    def site_name_list(self, site):
-        """
-        Recursively find site parents and return the list of [Parent, Parent..., Child]
-        """
-        result = []
-        if site.site_parent_id > 0:
-            parent_site = self.session.query(GDiveLogDB.Site).filter(GDiveLogDB.Site.site_id == site.site_parent_id).one()
-            result = self.site_name_list(parent_site)
-            result.append(site.site_name)
-        return result
-
-
-    def site_name(self, siteid):
-        """
-        Returns a sitename given the siteid. Uses site_name_list to find all the parents.
-        """
-        site = self.session.query(GDiveLogDB.Site).filter(GDiveLogDB.Site.site_id == siteid).one()
-        return self.preferences.site_name_seperator.join(self.site_name_list(site))
-
@@ -0,0 +1,122 @@
+"""
+Profile simplification for --max-samples and --tolerance
+"""
+
+import heapq
+
+
+__all__ = ['ProfileSimplifier', 'simplify']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+def simplify(times, depths, pinned=(), max_samples=None, tolerance=None):
+    """
+    Simplify a time/depth profile, returns the sorted list of indices of
+    the samples to keep.
+
+    Works bottom up like Visvalingam-Whyatt: the sample whose removal
+    changes the profile the least is removed first, where the change
+    is the depth difference between the sample and the line between
+    its remaining neighbours (at least the change of any sample removed
+    before in its place). Samples are removed while that is within
+    tolerance, or while there are more than max_samples left. With a
+    heap of candidates this is O(n log n), where top down
+    Ramer-Douglas-Peucker is O(n^2) on bad profiles.
+
+    The first and last sample and the ones in pinned are always kept.
+    """
+    count = len(times)
+    if count <= 2:
+        return range(count)
+
+    keep = set(pinned)
+    keep.update((0, count - 1))
+    prev = range(-1, count - 1)
+    next = range(1, count + 1)
+    removed = [False] * count
+    errors = [None] * count
+
+    def error(idx):
+        p, q = prev[idx], next[idx]
+        dt = times[q] - times[p]
+        if dt:
+            line = depths[p] + (depths[q] - depths[p]) * (times[idx] - times[p]) / float(dt)
+        else:
+            line = depths[p]
+        return abs(depths[idx] - line)
+
+    heap = []
+    for idx in xrange(1, count - 1):
+        if idx not in keep:
+            errors[idx] = error(idx)
+            heap.append((errors[idx], idx))
+    heapq.heapify(heap)
+
+    while heap:
+        err, idx = heap[0]
+        if removed[idx] or err != errors[idx]:
+            # Stale, the sample was removed or its error updated.
+            heapq.heappop(heap)
+            continue
+        within_tolerance = tolerance is not None and err <= tolerance
+        too_many = max_samples is not None and count > max_samples
+        if not within_tolerance and not too_many:
+            break
+        heapq.heappop(heap)
+        removed[idx] = True
+        count -= 1
+        p, q = prev[idx], next[idx]
+        next[p] = q
+        prev[q] = p
+        for neighbour in (p, q):
+            if neighbour not in keep:
+                errors[neighbour] = max(error(neighbour), err)
+                heapq.heappush(heap, (errors[neighbour], neighbour))
+
+    return [idx for idx in xrange(len(times)) if not removed[idx]]
+
+
+class ProfileSimplifier(object):
+    """
+    Simplifies dive profiles with simplify, keeping the samples at the
+    max depth and the temperature extremes, and counts the samples in
+    and out for the report.
+    """
+
+    def __init__(self, max_samples=None, tolerance=None):
+        self.max_samples = max_samples
+        self.tolerance = tolerance
+        self.samples_in = 0
+        self.samples_out = 0
+
+
+    def __call__(self, times, depths, temperatures, pinned=()):
+        """
+        Returns the sorted list of indices of the samples to keep.
+        """
+        keep = set(pinned)
+        if len(times):
+            keep.add(max(xrange(len(depths)), key=depths.__getitem__))
+            keep.add(min(xrange(len(temperatures)), key=temperatures.__getitem__))
+            keep.add(max(xrange(len(temperatures)), key=temperatures.__getitem__))
+        indices = simplify(times, depths, keep, self.max_samples, self.tolerance)
+        self.samples_in += len(times)
+        self.samples_out += len(indices)
+        return indices
+
+
+    def add_counts(self, samples_in, samples_out):
+        '''Add the counts from a simplifier in another process'''
+        self.samples_in += samples_in
+        self.samples_out += samples_out
+
+
+    def report(self):
+        if not self.samples_out:
+            return 'Profile samples: none'
+        return 'Profile samples: kept %d of %d (%.1f:1)' % (self.samples_out, self.samples_in, float(self.samples_in) / self.samples_out)
@@ -0,0 +1,153 @@
+"""
+Cache of rendered <dive> elements for --dive-cache-dir, so unchanged dives aren't rendered again
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+
+__all__ = ['DiveCache']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+class DiveCache(object):
+    """
+    Persistent cache of the text of <dive> elements, keyed by a digest
+    of everything an element is made from (see GDiveLogUDDF._dive_key),
+    so a dive that hasn't changed since an earlier export is written
+    as it was then instead of rendered again. Each is kept with the
+    counts rendering it added to the reports, a tuple of integers.
+
+    Kept in an sqlite db in the cache directory, which several
+    processes can use at once. Entries are touched when used, and when
+    the cache is opened or grows past max_size bytes the least recently
+    used ones are removed until it fits. The cache is only an optimization,
+    if it can't be read or written it's reported with verbose and not
+    used for the rest of the export.
+
+    One DiveCache can be shared by threads, eg. the --serve request
+    handlers; get and put hold a lock.
+    """
+
+    FILE = 'dives.sqlite'
+
+    # Kept in the db's user_version, a cache with another is emptied.
+    SCHEMA_VERSION = 1
+
+    def __init__(self, directory, max_size, verbose=False):
+        """
+        Args;
+           directory -- created if it doesn't exist.
+           max_size -- in bytes.
+           verbose -- report what's done to stderr.
+        """
+        self.verbose = verbose
+        self.max_size = max_size
+        self.size = 0
+        self.connection = None
+        self.lock = threading.Lock()
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Used by one thread at a time, under lock.
+            self.connection = sqlite3.connect(os.path.join(directory, DiveCache.FILE), check_same_thread=False,
+                                              isolation_level=None)
+            # WAL lets readers carry on while another process adds dives,
+            # and only syncs at checkpoints; losing the last few entries
+            # in a crash just means rendering them again.
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('PRAGMA synchronous = NORMAL')
+            self._create()
+            self._evict(max_size)
+        except (OSError, sqlite3.Error), e:
+            self._failed(e)
+
+
+    def _log(self, message):
+        if self.verbose:
+            print >> sys.stderr, message
+
+
+    def _failed(self, error):
+        self._log('Not using the dive cache: %s' % error)
+        self.connection = None
+
+
+    def _create(self):
+        '''Create the table, or recreate it if it's from another SCHEMA_VERSION'''
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            version, = self.connection.execute('PRAGMA user_version').fetchone()
+            if version != DiveCache.SCHEMA_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS dives')
+                self.connection.execute('PRAGMA user_version = %d' % DiveCache.SCHEMA_VERSION)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS dives (key TEXT PRIMARY KEY, text TEXT, counts TEXT, size INTEGER, used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS dives_used ON dives (used)')
+
+
+    def _evict(self, max_size):
+        '''Remove the least recently used dives until the cache fits in max_size'''
+        total, = self.connection.execute('SELECT coalesce(sum(size), 0) FROM dives').fetchone()
+        self.size = total
+        if total <= max_size:
+            return
+        keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM dives ORDER BY used'):
+            if total <= max_size:
+                break
+            keys.append((key,))
+            total -= size
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM dives WHERE key = ?', keys)
+        self.size = total
+        self._log('Evicted %d dives from the dive cache' % len(keys))
+
+
+    def get(self, key):
+        '''The (text, counts) cached for key, or None'''
+        with self.lock:
+            return self._get(key)
+
+
+    def _get(self, key):
+        if self.connection is None:
+            return None
+        try:
+            row = self.connection.execute('SELECT text, counts FROM dives WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE dives SET used = ? WHERE key = ?', (time.time(), key))
+            return row[0], tuple(int(count) for count in row[1].split(',') if count)
+        except sqlite3.Error, e:
+            self._failed(e)
+            return None
+
+
+    def put(self, key, text, counts=()):
+        '''Cache text and the tuple of integers counts for key'''
+        with self.lock:
+            self._put(key, text, counts)
+
+
+    def _put(self, key, text, counts):
+        if self.connection is None:
+            return
+        try:
+            self.connection.execute('INSERT OR REPLACE INTO dives (key, text, counts, size, used) VALUES (?, ?, ?, ?, ?)',
+                                    (key, text, ','.join('%d' % count for count in counts), len(text), time.time()))
+            # Only an estimate, other processes add dives too.
+            self.size += len(text)
+            if self.size > self.max_size:
+                # With some room, so it isn't done again for the next dive.
+                self._evict(self.max_size * 3 / 4)
+        except sqlite3.Error, e:
+            self._failed(e)
@@ -0,0 +1,205 @@
+"""
+Timers and counters for --profile-report
+"""
+
+import sys
+import time
+import resource
+from contextlib import contextmanager
+
+
+__all__ = ['Instrumentation', 'NULL_INSTRUMENTATION']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+class _CountingWriter(object):
+    '''Passes writes on to out, counting the bytes'''
+
+    def __init__(self, out, instrument):
+        self.out = out
+        self.instrument = instrument
+
+    def write(self, data):
+        self.instrument.counters['bytes written'] += len(data)
+        self.out.write(data)
+
+
+class _NullInstrumentation(object):
+    """
+    Instrumentation that does nothing, used when --profile-report is
+    off. Code doing more than a call per dive or per query checks
+    enabled and skips the instrumentation instead.
+    """
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def dive(self, dive_id, seconds):
+        pass
+
+
+NULL_INSTRUMENTATION = _NullInstrumentation()
+
+
+class Instrumentation(object):
+    """
+    Records the time spent in each stage of an export, counters such as
+    queries issued and rows fetched, and the build time of each dive.
+
+    Optionally runs cProfile over one of the stages.
+    """
+
+    enabled = True
+
+    def __init__(self, profile_stage=None):
+        self.timers = {}
+        self.peak_rss_kb = {}
+        self.counters = {'queries': 0, 'rows': 0, 'nodes': 0, 'bytes written': 0}
+        self.dive_times = []
+        self.profile_stage = profile_stage
+        self.profiler = None
+        if profile_stage:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+
+    @contextmanager
+    def stage(self, name):
+        '''Time the enclosed block as stage name, adding up repeated entries'''
+        profile = self.profiler is not None and name == self.profile_stage
+        if profile:
+            self.profiler.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.time() - start
+            if profile:
+                self.profiler.disable()
+            self.peak_rss_kb[name] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def dive(self, dive_id, seconds):
+        '''Record the time it took to build a dive'''
+        self.dive_times.append((seconds, dive_id))
+
+
+    def counting(self, out):
+        '''Wrap the file like out to count the bytes written to it'''
+        return _CountingWriter(out, self)
+
+
+    def counted(self, function, name):
+        '''Wrap function to count its calls as name'''
+        def wrapper(*args, **kwargs):
+            self.counters[name] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+
+    def rows(self, query):
+        '''Iterate across query, counting the rows'''
+        for row in query:
+            self.counters['rows'] += 1
+            yield row
+
+
+    @contextmanager
+    def query(self):
+        '''Count and time the query run in the enclosed block'''
+        self.counters['queries'] += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timers['sql'] = self.timers.get('sql', 0.0) + time.time() - start
+
+
+    def watch_engine(self, engine):
+        '''Count and time the queries run on a SQLAlchemy engine'''
+        import sqlalchemy.event
+        starts = []
+        def before(*args):
+            self.counters['queries'] += 1
+            starts.append(time.time())
+        def after(*args):
+            self.timers['sql'] = self.timers.get('sql', 0.0) + time.time() - starts.pop()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', before)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', after)
+
+
+    def data(self):
+        '''The results as a dict, see merge'''
+        return {'timers': self.timers, 'counters': self.counters,
+                'peak_rss_kb': self.peak_rss_kb, 'dive_times': self.dive_times}
+
+
+    def merge(self, data):
+        '''Add the results from an Instrumentation in another process'''
+        for name, seconds in data['timers'].iteritems():
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+        for name, n in data['counters'].iteritems():
+            self.count(name, n)
+        for name, kb in data['peak_rss_kb'].iteritems():
+            self.peak_rss_kb[name] = max(self.peak_rss_kb.get(name, 0), kb)
+        self.dive_times.extend(tuple(entry) for entry in data['dive_times'])
+
+
+    def summary(self):
+        data = self.data()
+        dive_times = sorted(self.dive_times, reverse=True)
+        if dive_times:
+            total = sum(seconds for seconds, dive_id in dive_times)
+            data['dives'] = {'count': len(dive_times),
+                             'mean': total / len(dive_times),
+                             'slowest': [{'dive_id': dive_id, 'seconds': seconds} for seconds, dive_id in dive_times[:5]]}
+        del data['dive_times']
+        return data
+
+
+    def report(self, out=sys.stderr):
+        '''Print a human readable summary to out'''
+        summary = self.summary()
+        print >> out, 'Stages:'
+        for name, seconds in sorted(self.timers.iteritems(), key=lambda e: -e[1]):
+            rss = self.peak_rss_kb.get(name)
+            print >> out, '  %-16s %9.3fs%s' % (name, seconds, rss and '   peak %d MB' % (rss / 1024) or '')
+        print >> out, 'Counters:'
+        for name, n in sorted(self.counters.iteritems()):
+            print >> out, '  %-16s %10d' % (name, n)
+        if 'dives' in summary:
+            dives = summary['dives']
+            cached = ''
+            if self.counters.get('cached dives'):
+                # Their times are for getting them from the cache.
+                cached = ' (%d from the dive cache)' % self.counters['cached dives']
+            print >> out, 'Dives: %d built%s, %.2fms on average, slowest %s' % (
+                dives['count'], cached, dives['mean'] * 1000,
+                ', '.join('dive %d %.2fms' % (entry['dive_id'], entry['seconds'] * 1000) for entry in dives['slowest']))
+
+
+    def write_json(self, fname):
+        import json
+        with open(fname, 'w') as out:
+            json.dump(self.summary(), out, indent=1, sort_keys=True)
+
+
+    def write_profile(self, fname):
+        '''Dump the cProfile stats of the profiled stage, for pstats'''
+        if self.profiler is not None:
+            self.profiler.dump_stats(fname)
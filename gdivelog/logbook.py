@@ -0,0 +1,503 @@
+"""
+What the database backends for gdivelog's sqlite db have in common
+"""
+
+import os
+import sys
+import stat
+import time
+import sqlite3
+import hashlib
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+from gdivelog.cache import DecompressionCache, decompress
+from gdivelog.instrument import NULL_INSTRUMENTATION
+
+
+__all__ = ['Logbook', 'DiveContext', 'Samples', 'TABLES', 'INDEXES', 'PRAGMAS', 'BACKENDS', 'open_logbook', 'index_logbook']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+# The tables and columns of gdivelog's db that are read, in the order they're declared.
+TABLES = [
+    ('Site', ('site_id', 'site_parent_id', 'site_name', 'site_notes')),
+    ('Dive', ('dive_id', 'dive_number', 'dive_datetime', 'dive_duration', 'dive_maxdepth', 'dive_mintemp',
+              'dive_maxtemp', 'dive_notes', 'site_id', 'dive_visibility', 'dive_weight')),
+    ('Profile', ('dive_id', 'profile_time', 'profile_depth', 'profile_temperature')),
+    ('Buddy', ('buddy_id', 'buddy_name', 'buddy_notes')),
+    ('Dive_Buddy', ('dive_id', 'buddy_id')),
+    ('Equipment', ('equipment_id', 'equipment_name', 'equipment_notes')),
+    ('Dive_Equipment', ('equipment_id', 'dive_id')),
+    ('Tank', ('tank_id', 'tank_name', 'tank_volume', 'tank_wp', 'tank_notes')),
+    ('Dive_Tank', ('dive_tank_id', 'dive_id', 'tank_id', 'dive_tank_avg_depth', 'dive_tank_O2', 'dive_tank_He',
+                   'dive_tank_stime', 'dive_tank_etime', 'dive_tank_spressure', 'dive_tank_epressure')),
+]
+
+# The indexes the queries use, created in the decompressed copy where
+# it doesn't have them, see Logbook._index_tables. The one on Profile
+# covers the columns read, in the order they're read, so the samples
+# come from the index alone. The per dive ones are on dive_id only, a
+# covering index would return a dive's buddies and equipment in a
+# different order than the table has them. The ones on Dive are for
+# the columns a Selection compares.
+INDEXES = [
+    ('Profile', ('dive_id', 'profile_time', 'profile_depth', 'profile_temperature')),
+    ('Dive_Tank', ('dive_id',)),
+    ('Dive_Buddy', ('dive_id',)),
+    ('Dive_Equipment', ('dive_id',)),
+    ('Dive', ('dive_number',)),
+    ('Dive', ('dive_datetime',)),
+    ('Dive', ('site_id',)),
+    ('Dive', ('dive_maxdepth',)),
+    ('Dive', ('dive_duration',)),
+]
+
+# Part of the name of the DecompressionCache's copies, so the ones
+# indexed for different INDEXES aren't used.
+INDEXES_KEY = hashlib.sha1(repr(INDEXES)).hexdigest()[:8]
+
+# Run on every connection. The converter only reads the db (see
+# Logbook._writable for the exceptions), and reads every table once, so
+# let sqlite map the file and cache generously.
+PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA mmap_size = 268435456',
+)
+
+# --backend name -> (module, class)
+BACKENDS = {
+    'sqlalchemy': ('gdivelog.db', 'GDiveLogDB'),
+    'sqlite': ('gdivelog.sqlitedb', 'GDiveLogSQLite'),
+}
+
+
+def _index_sql(table, columns):
+    '''Returns (name, CREATE INDEX statement) for our index on table's columns'''
+    name = 'gdivelog2uddf_%s_%s' % (table, '_'.join(columns))
+    return name, 'CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (name, table, ', '.join(columns))
+
+
+def index_logbook(filename):
+    """
+    Create the INDEXES in the decompressed database filename. The
+    DecompressionCache does this before the file is shared, so the
+    processes using it don't each have to.
+    """
+    connection = sqlite3.connect(filename, isolation_level=None)
+    try:
+        for table, columns in INDEXES:
+            connection.execute(_index_sql(table, columns)[1])
+    finally:
+        connection.close()
+
+
+def open_logbook(options, preferences, filename=None, instrument=NULL_INSTRUMENTATION):
+    """
+    Open the logbook with the backend chosen by options.backend. Only
+    that backend's module is imported.
+    """
+    module, name = BACKENDS[options.backend]
+    backend = getattr(__import__(module, fromlist=[name]), name)
+    return backend(options, preferences, filename=filename, instrument=instrument)
+
+
+class Samples(object):
+    """
+    The profile of a dive as columns of profile_time, profile_depth
+    and profile_temperature, in order of time.
+    """
+
+    __slots__ = ('times', 'depths', 'temperatures')
+
+    def __init__(self):
+        self.times = array('l')
+        self.depths = array('d')
+        self.temperatures = array('d')
+
+    def append(self, time, depth, temperature):
+        self.times.append(time)
+        self.depths.append(depth)
+        self.temperatures.append(temperature)
+
+    def __len__(self):
+        return len(self.times)
+
+
+class DiveContext(object):
+    """
+    A dive and its related rows, see Logbook.dive_contexts.
+
+    tanks is a list of (DiveTank, Tank), buddies and equipment are the
+    DiveBuddy and DiveEquipment rows as returned by the buddies and
+    equipment generators, samples is the profile as Samples.
+    """
+
+    __slots__ = ('dive', 'tanks', 'buddies', 'equipment', 'samples')
+
+    def __init__(self, dive):
+        self.dive = dive
+        self.tanks = []
+        self.buddies = []
+        self.equipment = []
+        self.samples = Samples()
+
+    def update_digest(self, digest):
+        """
+        Add the dive's rows to the hashlib object digest, which then
+        changes if anything about the dive does.
+        """
+        columns = dict(TABLES)
+        digest.update(repr([getattr(self.dive, column) for column in columns['Dive']]))
+        for dive_tank, tank in self.tanks:
+            digest.update(repr(([getattr(dive_tank, column) for column in columns['Dive_Tank']],
+                                [getattr(tank, column) for column in columns['Tank']])))
+        digest.update(repr([buddy.buddy_id for buddy in self.buddies]))
+        digest.update(repr([equipment.equipment_id for equipment in self.equipment]))
+        for column in (self.samples.times, self.samples.depths, self.samples.temperatures):
+            digest.update(column.tostring())
+
+
+class Logbook(object):
+    """
+    Base class of the backends. Finds the decompressed database file
+    and implements what doesn't depend on how it's queried. The
+    backends implement the generators (dives, dive_timeline, samples,
+    dive_tanks, buddies, equipment, tanks, sites, mixes),
+    dive_contexts, tank_by_id, dive_by_id, and _execute and _dbapi for
+    the raw SQL here, and call _index_tables once the db is open.
+
+    dives, dive_timeline and mixes take a Selection, see selected.
+    """
+
+    # Number of dives dive_contexts loads at a time.
+    CONTEXT_WINDOW = 100
+
+    # Lists of more ids than this go in a temporary table instead of the SQL, see _id_set.
+    ID_LIST_LIMIT = 100
+
+    # For references; table -> (column, table it's referenced from by dive_id)
+    _REFERENCES = {
+        'Site': ('site_id', 'Dive'),
+        'Buddy': ('buddy_id', 'Dive_Buddy'),
+        'Equipment': ('equipment_id', 'Dive_Equipment'),
+        'Tank': ('tank_id', 'Dive_Tank'),
+    }
+
+    def __init__(self, options, preferences, filename=None, instrument=NULL_INSTRUMENTATION):
+        """
+        Finds the logbook in options.gdivelog_db, or if filename is
+        given the already decompressed database in that file.
+
+        instrument is the Instrumentation to count queries and rows with.
+        """
+        self.preferences = preferences
+        self.instrument = instrument
+        self.verbose = options.verbose
+        if filename:
+            self.filename = filename
+        elif options.db_cache_dir:
+            cache = DecompressionCache(options.db_cache_dir, options.db_cache_size * 1024 * 1024, verbose=options.verbose,
+                                       prepare=index_logbook, prepare_key=INDEXES_KEY)
+            self.filename = cache.get(options.gdivelog_db)
+        else:
+            self.bunzipped2 = tempfile.NamedTemporaryFile(delete=True)
+            decompress(options.gdivelog_db, self.bunzipped2)
+            self.filename = self.bunzipped2.name
+        # The cache's copies are read only and shared with other
+        # processes, only the temporary tables are written with them.
+        # Checked on the mode, since root could write them anyway.
+        self.shared = not os.stat(self.filename).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+        # See _site_index and _site_path.
+        self._sites = None
+        self._site_paths = {}
+
+        # See _temporary_table, selected and _ensure_index.
+        self._temporary_tables = []
+        self._temporary_count = 0
+        self._selections = {}
+        self._indexes = {}
+
+
+    def _rows(self, query):
+        '''Iterate across the rows of query, counting them if instrumented'''
+        if self.instrument.enabled:
+            return self.instrument.rows(query)
+        return query
+
+
+    def _execute(self, sql):
+        '''Run a raw SQL statement, returning an iterable of row tuples'''
+        raise NotImplementedError
+
+
+    def _dbapi(self):
+        '''The sqlite3 connection, for the temporary tables and indexes'''
+        raise NotImplementedError
+
+
+    def release(self):
+        """
+        Called when done with the logbook for now, before it's used
+        from another thread. Ends any open read transaction and drops
+        the temporary tables.
+        """
+        if self._temporary_tables:
+            with self._writable() as connection:
+                for name in self._temporary_tables:
+                    connection.execute('DROP TABLE IF EXISTS temp.%s' % name)
+        self._temporary_tables = []
+        self._selections = {}
+
+
+    @contextmanager
+    def _writable(self):
+        """
+        Lift query_only for the temporary tables and indexes, the only
+        writes the converter makes. Yields the sqlite3 connection. With
+        a shared copy, only for temporary tables, see _ensure_index.
+        """
+        connection = self._dbapi()
+        connection.execute('PRAGMA query_only = OFF')
+        try:
+            yield connection
+        finally:
+            connection.execute('PRAGMA query_only = ON')
+
+
+    def _temporary_table(self, prefix, columns):
+        '''Create a temporary table, dropped by release, and return its name'''
+        self._temporary_count += 1
+        name = 'gdivelog2uddf_%s_%d' % (prefix, self._temporary_count)
+        with self._writable() as connection:
+            connection.execute('CREATE TEMP TABLE %s (%s)' % (name, columns))
+        self._temporary_tables.append(name)
+        return name
+
+
+    def _id_set(self, ids):
+        """
+        The SQL for the set of integers ids, to go after IN. Up to
+        ID_LIST_LIMIT are listed, more go in a temporary table so the
+        statement stays small and needs no parameters.
+        """
+        ids = list(ids)
+        if len(ids) <= self.ID_LIST_LIMIT:
+            return '(%s)' % ', '.join('%d' % value for value in ids)
+        name = self._temporary_table('ids', 'value INTEGER PRIMARY KEY')
+        with self._writable() as connection:
+            connection.executemany('INSERT OR IGNORE INTO temp.%s VALUES (?)' % name, ((value,) for value in ids))
+        return '(SELECT value FROM temp.%s)' % name
+
+
+    def _ensure_index(self, table, columns):
+        """
+        Create an index on table's columns, unless one starts with them
+        already. gdivelog's db has none but the primary keys, so eg.
+        each window of dive_contexts would scan all of Profile. SQLite
+        can't put a temporary index on a table in the db, so it goes in
+        the decompressed copy. The cache's copies are shared, so they
+        get the INDEXES before that, see index_logbook, and are never
+        indexed here. It's only an optimization, not indexing is
+        reported with --verbose.
+
+        Returns the name of the index, or None.
+        """
+        key = (table, columns)
+        if key in self._indexes:
+            return self._indexes[key]
+        name = None
+        connection = self._dbapi()
+        for index in list(connection.execute('PRAGMA index_list("%s")' % table)):
+            indexed = tuple(row[2] for row in connection.execute('PRAGMA index_info("%s")' % index[1]))
+            if indexed[:len(columns)] == columns:
+                name = index[1]
+                break
+        if name is None and self.shared:
+            if self.verbose:
+                print >> sys.stderr, 'Not indexing %s (%s) in the shared copy %s' % (table, ', '.join(columns), self.filename)
+        elif name is None:
+            name, sql = _index_sql(table, columns)
+            start = time.time()
+            try:
+                with self._writable() as connection:
+                    connection.execute(sql)
+            except Exception, e:
+                if self.verbose:
+                    print >> sys.stderr, 'Not indexing %s (%s): %s' % (table, ', '.join(columns), e)
+                name = None
+            else:
+                if self.verbose:
+                    print >> sys.stderr, 'Created index %s in %.3f s' % (name, time.time() - start)
+        self._indexes[key] = name
+        return name
+
+
+    def _index_tables(self):
+        """
+        Make sure the db has the INDEXES, which only takes looking
+        when the cached copy got them on an earlier run. With --verbose,
+        prints how sqlite will run the per dive query on each table.
+        """
+        for table, columns in INDEXES:
+            self._ensure_index(table, columns)
+            if self.verbose and columns[0] == 'dive_id':
+                sql = 'SELECT %s FROM %s WHERE dive_id IN (1, 2)' % (', '.join(dict(TABLES)[table]), table)
+                plan = '; '.join(row[-1] for row in self._dbapi().execute('EXPLAIN QUERY PLAN ' + sql))
+                print >> sys.stderr, 'Query plan for %s: %s' % (table, plan)
+
+
+    def selected(self, selection):
+        """
+        The condition on dive_id for the dives a Selection selects, or
+        None for no selection. The first time a selection is used its
+        dive_ids go in a temporary table, found with the INDEXES on the
+        Dive columns it compares, so the rest of the queries only look
+        up the dives in that.
+        """
+        if selection is None:
+            return None
+        key = selection.key()
+        if key not in self._selections:
+            where, params = selection.compile(self)
+            name = self._temporary_table('selection', 'dive_id INTEGER PRIMARY KEY')
+            with self._writable() as connection:
+                connection.execute('INSERT INTO temp.%s SELECT dive_id FROM Dive WHERE %s' % (name, where), params)
+            self._selections[key] = 'dive_id IN (SELECT dive_id FROM temp.%s)' % name
+        return self._selections[key]
+
+
+    def _fingerprint_rows(self, table, group_by=None):
+        """
+        SQL selecting each row of table quoted and joined into a
+        string, in rowid order. With group_by, the rows are aggregated
+        into one string per value of that column.
+        """
+        columns = dict(TABLES)[table]
+        row = " || ',' || ".join('quote(%s)' % column for column in columns)
+        if group_by:
+            return ("SELECT %s, group_concat(%s, ';') FROM (SELECT * FROM %s ORDER BY %s, rowid) GROUP BY %s"
+                    % (group_by, row, table, group_by, group_by))
+        return "SELECT group_concat(%s, ';') FROM (SELECT * FROM %s ORDER BY rowid)" % (row, table)
+
+
+    def dive_fingerprints(self):
+        """
+        Returns {dive_id: fingerprint} where the fingerprint is a sha1 over
+        the dive's rows in Dive, Profile, Dive_Tank, Dive_Buddy and
+        Dive_Equipment. The rows are aggregated per dive in SQL, one
+        query per table.
+        """
+        digests = {}
+        for table in ('Dive', 'Profile', 'Dive_Tank', 'Dive_Buddy', 'Dive_Equipment'):
+            for dive_id, rows in self._execute(self._fingerprint_rows(table, group_by='dive_id')):
+                if dive_id not in digests:
+                    digests[dive_id] = hashlib.sha1()
+                digests[dive_id].update('%s:%s\n' % (table, (rows or u'').encode('utf-8')))
+        return dict((dive_id, digest.hexdigest()) for dive_id, digest in digests.iteritems())
+
+
+    def catalogue_fingerprint(self):
+        """
+        Returns a sha1 over the Site, Buddy, Equipment and Tank tables, which every document includes.
+        """
+        digest = hashlib.sha1()
+        for table in ('Site', 'Buddy', 'Equipment', 'Tank'):
+            for rows, in self._execute(self._fingerprint_rows(table)):
+                digest.update('%s:%s\n' % (table, (rows or u'').encode('utf-8')))
+        return digest.hexdigest()
+
+
+    def references(self, dive_ids):
+        """
+        The rows the dives with dive_ids refer to, as a dict of
+        {table: set of ids} for Site, Buddy, Equipment and Tank. One
+        query per table for all the dives.
+        """
+        references = dict((table, set()) for table in self._REFERENCES)
+        if not dive_ids:
+            return references
+        where = 'WHERE dive_id IN %s' % self._id_set(dive_ids)
+        for table, (column, from_table) in self._REFERENCES.iteritems():
+            query = self._execute('SELECT DISTINCT %s FROM %s %s' % (column, from_table, where))
+            references[table].update(row_id for row_id, in self._rows(query))
+        references['Site'].discard(None)
+        return references
+
+
+    def _site_index(self):
+        """
+        The Site table as {site_id: (site_parent_id, site_name)}, loaded on first use.
+        """
+        if self._sites is None:
+            query = self._execute('SELECT site_id, site_parent_id, site_name FROM Site')
+            self._sites = dict((site_id, (parent_id, name)) for site_id, parent_id, name in self._rows(query))
+        return self._sites
+
+
+    def _site_path(self, siteid):
+        """
+        Returns the tuple of site names (Parent, Parent..., Child) for
+        siteid, () for a dive without a site (siteid 0 or None). Each
+        site's path is only computed once.
+
+        Walks up the parents iteratively. A parent that doesn't exist
+        or a cycle in the tree is reported and treated as the top of
+        the tree.
+        """
+        if siteid is None or siteid <= 0:
+            return ()
+        paths = self._site_paths
+        sites = self._site_index()
+
+        chain = []
+        seen = set()
+        current = siteid
+        while current not in paths:
+            if current not in sites:
+                if chain:
+                    print >> sys.stderr, 'Site %d has unknown parent site %d' % (chain[-1], current)
+                else:
+                    print >> sys.stderr, 'Unknown site %d' % current
+                paths[current] = ()
+                break
+            parent_id, name = sites[current]
+            if current in seen:
+                print >> sys.stderr, 'Site %d is its own ancestor' % current
+                paths[current] = (name,)
+                break
+            if not parent_id > 0:
+                paths[current] = ()
+                break
+            chain.append(current)
+            seen.add(current)
+            current = parent_id
+
+        for site_id in reversed(chain):
+            if site_id not in paths:
+                parent_id, name = sites[site_id]
+                paths[site_id] = paths[parent_id] + (name,)
+        return paths[siteid]
+
+
+    def site_name_list(self, site):
+        """
+        Find site parents and return the list of [Parent, Parent..., Child]
+        """
+        return list(self._site_path(site.site_id))
+
+
+    def site_name(self, siteid):
+        """
+        Returns a sitename given the siteid. Uses _site_path to find all the parents.
+        """
+        return self.preferences.site_name_seperator.join(self._site_path(siteid))
@@ -0,0 +1,92 @@
+"""
+Manifest of the segment files written by an export, for --since-manifest
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+from gdivelog import NAME, VERSION
+
+
+__all__ = ['Manifest']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+# Options that change the contents of a segment file.
+_OUTPUT_OPTIONS = ('prettyprint', 'trip_si_threshold', 'segment_size', 'max_samples', 'tolerance', 'prune_references')
+
+
+class Manifest(object):
+    """
+    Records the file name and a fingerprint of every segment written.
+
+    A segment's fingerprint covers its dives (see
+    Logbook.dive_fingerprints) and their place in the plan, the
+    sites, buddies, equipment and tanks every document carries, the
+    preferences and the options that affect the output. A segment
+    whose fingerprint matches the manifest and whose file is still
+    there doesn't have to be written again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        if os.path.exists(path):
+            with open(path) as manifest:
+                self.segments = json.load(manifest)['segments']
+
+
+    def fingerprint_segments(self, db, preferences, options, plans):
+        """
+        Returns the fingerprint for each segment in plans, as from GDiveLogUDDF.plan_segments.
+        """
+        common = hashlib.sha1()
+        common.update('%s %s\n' % (NAME, VERSION))
+        common.update('%r\n' % sorted(preferences.__dict__.items()))
+        common.update('%r\n' % [(name, getattr(options, name)) for name in _OUTPUT_OPTIONS])
+        common.update(db.catalogue_fingerprint())
+
+        dives = db.dive_fingerprints()
+        fingerprints = []
+        for plan in plans:
+            digest = common.copy()
+            for dive_id, surfaceinterval, repititiongroup_id in plan:
+                digest.update('%d %r %r %s\n' % (dive_id, surfaceinterval, repititiongroup_id, dives[dive_id]))
+            fingerprints.append(digest.hexdigest())
+        return fingerprints
+
+
+    def changed(self, idx, fname, fingerprint):
+        """
+        True if segment idx has to be written to fname.
+        """
+        if idx >= len(self.segments):
+            return True
+        segment = self.segments[idx]
+        return segment['file'] != fname or segment['fingerprint'] != fingerprint or not os.path.exists(fname)
+
+
+    def update(self, fnames, fingerprints):
+        """
+        Record the segments now written and remove the files of
+        segments beyond them left over from the previous export.
+        """
+        for segment in self.segments[len(fnames):]:
+            if segment['file'] not in fnames and os.path.exists(segment['file']):
+                os.unlink(segment['file'])
+        self.segments = [{'file': fname, 'fingerprint': fingerprint} for fname, fingerprint in zip(fnames, fingerprints)]
+
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump({'segments': self.segments}, out, indent=1)
+        os.rename(name, self.path)
@@ -0,0 +1,176 @@
+"""
+Output pipeline for --sink, writes documents to several outputs while they're generated
+"""
+
+import sys
+import threading
+from Queue import Queue
+# datetime.strptime imports this on first use, which isn't thread safe.
+import _strptime
+
+
+__all__ = ['Sink', 'FanOut', 'ThreadedOutput', 'run_threads']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+# Writes are passed on to the sinks in chunks of about this size, and
+# each sink queues up to QUEUE_CHUNKS of them before the generator
+# waits. So memory is bounded by CHUNK_SIZE * QUEUE_CHUNKS per sink.
+CHUNK_SIZE = 64 * 1024
+QUEUE_CHUNKS = 16
+
+# Queue items besides chunks of data.
+_OPEN, _CLOSE, _STOP = range(3)
+
+
+class Sink(threading.Thread):
+    """
+    Writes the documents put on its queue in a thread of its own, so
+    the writing overlaps with generating them.
+    """
+
+    def __init__(self, name, opener):
+        """
+        Args;
+           name -- for error messages.
+           opener -- function taking the document index, returning the
+              file like object to write it to. The sink closes it
+              after the document, unless it's sys.stdout.
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.opener = opener
+        self.queue = Queue(QUEUE_CHUNKS)
+        self.error = None
+
+
+    def put(self, item):
+        '''Queue item, waiting while the queue is full'''
+        self.queue.put(item)
+
+
+    def run(self):
+        out = None
+        while True:
+            item = self.queue.get()
+            if item == _STOP:
+                break
+            if self.error:
+                # Keep taking items so the generator isn't blocked.
+                continue
+            try:
+                if isinstance(item, str):
+                    out.write(item)
+                elif item[0] == _OPEN:
+                    out = self.opener(item[1])
+                elif item[0] == _CLOSE:
+                    if out is not sys.stdout:
+                        out.close()
+                    else:
+                        out.flush()
+                    out = None
+            except Exception, e:
+                self.error = e
+
+
+class FanOut(object):
+    """
+    File like object that passes what's written to it on to each of
+    sinks, a document at a time. Start the sinks first, and call
+    close when done.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.buffer = []
+        self.size = 0
+
+
+    def _put(self, item):
+        for sink in self.sinks:
+            sink.put(item)
+
+
+    def _flush(self):
+        if self.buffer:
+            self._put(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+
+    def start_document(self, idx):
+        self._put((_OPEN, idx))
+
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            self._flush()
+
+
+    def end_document(self):
+        self._flush()
+        self._put((_CLOSE,))
+
+
+    def close(self):
+        """
+        Wait for the sinks to finish writing. Raises the first error a
+        sink ran into.
+        """
+        self._put(_STOP)
+        for sink in self.sinks:
+            sink.join()
+        for sink in self.sinks:
+            if sink.error:
+                raise IOError('Writing %s failed: %s' % (sink.name, sink.error))
+
+
+class ThreadedOutput(object):
+    """
+    File like object writing to out from a Sink thread, so eg.
+    compressing out's data overlaps with generating it.
+    """
+
+    def __init__(self, out, name='output'):
+        self.sink = Sink(name, lambda idx: out)
+        self.sink.start()
+        self.fanout = FanOut([self.sink])
+        self.fanout.start_document(0)
+
+
+    def write(self, data):
+        self.fanout.write(data)
+
+
+    def close(self):
+        '''Wait for the data to be written and close out'''
+        self.fanout.end_document()
+        self.fanout.close()
+
+
+def run_threads(functions):
+    """
+    Call each of functions in a thread of its own and wait for them.
+    Re-raises the first exception any of them raised.
+    """
+    errors = []
+    def call(function):
+        try:
+            function()
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=call, args=(function,)) for function in functions]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
@@ -0,0 +1,243 @@
+"""
+Dive selection expressions for --select
+"""
+
+import re
+import shlex
+from fnmatch import fnmatchcase
+from datetime import datetime, timedelta
+
+
+__all__ = ['Selection', 'FIELDS']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+FIELDS = ('number', 'date', 'site', 'buddy', 'depth', 'duration')
+
+# Fields compared with a Dive column.
+_COLUMNS = {'number': 'dive_number', 'date': 'dive_datetime', 'depth': 'dive_maxdepth', 'duration': 'dive_duration'}
+
+_TERM = re.compile(r'^([a-z]+)(<=|>=|!=|=|<|>)(.*)$')
+_DURATION = re.compile(r'^(\d+(?:\.\d*)?)([smh]?)$')
+_DATE_FORMATS = (('%Y-%m-%dT%H:%M:%S', 'second'), ('%Y-%m-%dT%H:%M', 'minute'), ('%Y-%m-%d', 'day'),
+                 ('%Y-%m', 'month'), ('%Y', 'year'))
+_DATETIME = '%Y-%m-%d %H:%M:%S'
+
+
+def _date_range(value):
+    """
+    The [start, end) of what a date value covers as dive_datetime
+    strings, eg. 2011-07 covers 2011-07-01 00:00:00 to 2011-08-01 00:00:00.
+    """
+    for format, unit in _DATE_FORMATS:
+        try:
+            start = datetime.strptime(value, format)
+        except ValueError:
+            continue
+        if unit == 'year':
+            end = start.replace(year=start.year + 1)
+        elif unit == 'month':
+            end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        else:
+            end = start + timedelta(**{unit + 's': 1})
+        return start.strftime(_DATETIME), end.strftime(_DATETIME)
+    raise ValueError('Bad date %r, use YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS]' % value)
+
+
+def _number(field, value):
+    '''A number, depth or duration value'''
+    try:
+        if field == 'number':
+            return int(value)
+        if field == 'depth':
+            return float(value)
+        match = _DURATION.match(value)
+        if match:
+            return float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+    except ValueError:
+        pass
+    raise ValueError('Bad %s %r' % (field, value))
+
+
+class Selection(object):
+    """
+    Which dives to export, as given by --select and the dive numbers on
+    the command line. Compiles to SQL on the Dive table, see
+    Logbook.selected.
+
+    An expression is whitespace separated terms that all have to
+    match, each FIELD OP VALUE;
+
+      number, depth, duration -- = and != take a comma separated list of
+         values or MIN..MAX ranges (either end may be left out), <, <=,
+         > and >= a single value. Durations are in seconds, or with an
+         m or h suffix minutes or hours.
+      date -- as for number, where a value is YYYY, YYYY-MM,
+         YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS] and covers all of that
+         year, month, day etc.
+      site -- = or != a comma separated list of site names, matching
+         those sites and all sites under them. A name with the site
+         name separator in it matches the whole name. * and ? are
+         wildcards, case is ignored.
+      buddy -- = or != a comma separated list of buddy names, as for site.
+
+    Eg. 'date=2011 site=Egypt depth>30' or 'number=100..199,250 buddy!=Bob*'.
+    Quote values with spaces, 'site="Red Sea"'.
+    """
+
+    def __init__(self, expression=None, numbers=None):
+        """
+        Args;
+           expression -- the --select expression, raises ValueError if it's bad.
+           numbers -- dive numbers, eg. from the command line.
+        """
+        self.expression = expression
+        self.terms = []
+        if numbers:
+            self.terms.append(('number', '=', [(_number('number', number), None, False) for number in numbers]))
+        if expression:
+            try:
+                tokens = shlex.split(expression)
+            except ValueError, e:
+                raise ValueError('Bad --select %r: %s' % (expression, e))
+            for token in tokens:
+                self.terms.append(self._parse_term(token))
+
+
+    @staticmethod
+    def of(args):
+        """
+        The Selection for the args an exporter is given, either a
+        Selection or a list of dive numbers. None for all dives.
+        """
+        if isinstance(args, Selection):
+            return args
+        if args:
+            return Selection(numbers=args)
+        return None
+
+
+    def _parse_term(self, token):
+        match = _TERM.match(token)
+        if not match or match.group(1) not in FIELDS:
+            raise ValueError('Bad --select term %r, use FIELD=VALUE where FIELD is one of %s' % (token, ', '.join(FIELDS)))
+        field, op, value = match.groups()
+        if field in ('site', 'buddy'):
+            if op not in ('=', '!='):
+                raise ValueError('Bad --select term %r, %s only takes = and !=' % (token, field))
+            return field, op, [name for name in value.split(',') if name]
+
+        if op not in ('=', '!='):
+            if field == 'date':
+                return field, op, _date_range(value)
+            return field, op, _number(field, value)
+
+        # Each value is (low, high, is_range), a single value has no high.
+        values = []
+        for item in value.split(','):
+            low, dots, high = item.partition('..')
+            if field == 'date':
+                if dots:
+                    values.append((_date_range(low)[0] if low else None, _date_range(high)[1] if high else None, True))
+                else:
+                    values.append(_date_range(item) + (True,))
+            elif dots:
+                values.append((_number(field, low) if low else None, _number(field, high) if high else None, True))
+            else:
+                values.append((_number(field, item), None, False))
+        return field, op, values
+
+
+    def key(self):
+        '''Equal for selections of the same dives'''
+        return repr(self.terms)
+
+
+    def _value_sql(self, field, column, value, params):
+        low, high, is_range = value
+        if not is_range:
+            params.append(low)
+            return '%s = ?' % column
+        conditions = []
+        if low is not None:
+            conditions.append('%s >= ?' % column)
+            params.append(low)
+        if high is not None:
+            # A date range ends where its last value's period does.
+            conditions.append('%s %s ?' % (column, '<' if field == 'date' else '<='))
+            params.append(high)
+        return ' AND '.join(conditions) or '1'
+
+
+    def _term_sql(self, logbook, field, op, values, params):
+        if field == 'site':
+            return 'site_id IN %s' % logbook._id_set(_site_subtree(logbook, values))
+        if field == 'buddy':
+            buddies = [buddy.buddy_id for buddy in logbook.buddies() if _matches(buddy.buddy_name, values)]
+            return 'dive_id IN (SELECT dive_id FROM Dive_Buddy WHERE buddy_id IN %s)' % logbook._id_set(buddies)
+
+        column = _COLUMNS[field]
+        if op not in ('=', '!='):
+            start, end = values if field == 'date' else (values, values)
+            # A date covers a period, so eg. <= means before its end.
+            bound = {'<': start, '<=': end, '>': end, '>=': start}[op]
+            if field == 'date' and op in ('<=', '>'):
+                op = {'<=': '<', '>': '>='}[op]
+            params.append(bound)
+            return '%s %s ?' % (column, op)
+        if field == 'number' and len(values) > 1 and all(not is_range for low, high, is_range in values):
+            # Eg. the numbers from the command line, which may be many.
+            return '%s IN %s' % (column, logbook._id_set([low for low, high, is_range in values]))
+        return ' OR '.join('(%s)' % self._value_sql(field, column, value, params) for value in values)
+
+
+    def compile(self, logbook):
+        """
+        Returns (sql, params), the condition on the Dive table for the
+        selected dives. Site and buddy names are looked up in logbook.
+        """
+        conditions = []
+        params = []
+        for field, op, values in self.terms:
+            sql = self._term_sql(logbook, field, op, values, params)
+            if op == '!=':
+                # Dives without a value for the field don't match either way otherwise.
+                sql = 'NOT coalesce(%s, 0)' % sql
+            conditions.append('(%s)' % sql)
+        return ' AND '.join(conditions) or '1', params
+
+
+def _matches(name, patterns):
+    name = (name or u'').lower()
+    return any(fnmatchcase(name, pattern.lower()) for pattern in patterns)
+
+
+def _site_subtree(logbook, patterns):
+    """
+    The ids of the sites matching patterns and the sites under them.
+    """
+    sites = logbook._site_index()
+    separator = logbook.preferences.site_name_seperator
+    children = {}
+    for site_id, (parent_id, name) in sites.iteritems():
+        children.setdefault(parent_id, []).append(site_id)
+
+    by_path = [pattern for pattern in patterns if separator in pattern]
+    by_name = [pattern for pattern in patterns if separator not in pattern]
+    matched = []
+    for site_id, (parent_id, name) in sites.iteritems():
+        if (by_name and _matches(name, by_name)) or (by_path and _matches(logbook.site_name(site_id), by_path)):
+            matched.append(site_id)
+
+    subtree = set()
+    while matched:
+        site_id = matched.pop()
+        if site_id not in subtree:
+            subtree.add(site_id)
+            matched.extend(children.get(site_id, ()))
+    return sorted(subtree)
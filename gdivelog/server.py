@@ -0,0 +1,293 @@
+"""
+Conversion server for --serve, keeps the logbook open between exports
+"""
+
+import os
+import sys
+import copy
+import json
+import signal
+import socket
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from datetime import datetime
+# datetime.strptime imports this on first use, which isn't thread safe.
+import _strptime
+
+from gdivelog.logbook import open_logbook
+from gdivelog.divecache import DiveCache
+from gdivelog.prefs import GDiveLogPreferences
+from gdivelog.selection import Selection
+from gdivelog.uddf import GDiveLogUDDF
+from gdivelog.udcf import GDiveLogUDCF
+from gdivelog.writer import write_doc
+
+
+__all__ = ['LogbookPool', 'serve']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+def _file_key(fname):
+    '''What tells us fname has changed'''
+    stat = os.stat(fname)
+    return stat.st_mtime, stat.st_size
+
+
+class _Generation(object):
+    """
+    The preferences and decompressed logbook as of one version of the
+    files. Logbooks opened on it keep it, and thereby the decompressed
+    file, alive.
+
+    catalogue is the GDiveLogUDDF catalogue, set by the first UDDF
+    export on the generation and used by the ones after it.
+    """
+
+    def __init__(self, options, number):
+        self.number = number
+        self.key = (_file_key(options.gdivelog_db), _file_key(options.gdivelog_preferences))
+        self.loaded = datetime.now()
+        self.preferences = GDiveLogPreferences(options)
+        # Decompresses (or finds in the cache) the logbook.
+        self.first = open_logbook(options, self.preferences)
+        self.first.generation = self
+        self.catalogue = None
+
+
+class LogbookPool(object):
+    """
+    Logbooks on the current version of the log and preferences files,
+    each used by one request at a time. Idle logbooks are reused, with
+    their site index and connection warm.
+
+    Each acquire checks the files, and when they've changed the next
+    requests get logbooks on the new version, while the ones still
+    running finish on the old.
+
+    dive_cache is the DiveCache every UDDF export uses, opened once.
+    Its keys don't depend on the version of the files, so it's kept
+    across reloads.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.dive_cache = None
+        if options.dive_cache_dir:
+            self.dive_cache = DiveCache(options.dive_cache_dir, options.dive_cache_size * 1024 * 1024, verbose=options.verbose)
+        self.generation = _Generation(options, 1)
+        self.idle = [self.generation.first]
+
+
+    def _check(self):
+        try:
+            key = (_file_key(self.options.gdivelog_db), _file_key(self.options.gdivelog_preferences))
+            if key == self.generation.key:
+                return
+            generation = _Generation(self.options, self.generation.number + 1)
+        except Exception, e:
+            # Eg. the log is being written, try again on the next request.
+            print >> sys.stderr, 'Reloading %s failed: %s' % (self.options.gdivelog_db, e)
+            return
+        if self.options.verbose:
+            print >> sys.stderr, 'Reloaded %s' % self.options.gdivelog_db
+        self.generation = generation
+        self.idle = [generation.first]
+
+
+    def acquire(self):
+        '''A logbook for a request, hand it back with release'''
+        with self.lock:
+            self._check()
+            if self.idle:
+                return self.idle.pop()
+            generation = self.generation
+            filename = generation.first.filename
+        logbook = open_logbook(self.options, generation.preferences, filename=filename)
+        logbook.generation = generation
+        return logbook
+
+
+    def release(self, logbook):
+        logbook.release()
+        with self.lock:
+            if logbook.generation is self.generation:
+                self.idle.append(logbook)
+
+
+    def status(self):
+        with self.lock:
+            return {'logbook': self.options.gdivelog_db,
+                    'generation': self.generation.number,
+                    'loaded': self.generation.loaded.isoformat(),
+                    'idle': len(self.idle)}
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _request_options(options, query):
+    """
+    Returns (options, args, part) for an /export request from the server's
+    options and the query parameters;
+
+      dives -- comma separated dive numbers, default all
+      select -- only the dives matching this, as --select
+      format -- uddf (default) or udcf
+      segment -- segment size, with part the index of the segment to get
+      pretty, trip-threshold, max-samples, tolerance, prune -- as on the command line
+    """
+    def param(name, convert=str, default=None):
+        if name not in query:
+            return default
+        try:
+            return convert(query[name][-1])
+        except ValueError:
+            raise _BadRequest('Bad %s %r' % (name, query[name][-1]))
+
+    format = param('format', default='uddf')
+    if format not in ('uddf', 'udcf'):
+        raise _BadRequest('Unknown format %r' % format)
+    options = copy.copy(options)
+    options.udcf = format == 'udcf'
+    options.prettyprint = param('pretty', int, 0) != 0
+    options.segment_size = param('segment', int)
+    options.trip_si_threshold = param('trip-threshold', int, options.trip_si_threshold)
+    options.max_samples = param('max-samples', int, options.max_samples)
+    options.tolerance = param('tolerance', float, options.tolerance)
+    options.prune_references = param('prune', int, int(options.prune_references)) != 0
+    # Same output, but written as it's generated.
+    options.stream = True
+    numbers = [number for number in param('dives', default='').split(',') if number]
+    for number in numbers:
+        if not number.isdigit():
+            raise _BadRequest('Bad dive number %r' % number)
+    select = param('select')
+    args = None
+    if select or numbers:
+        try:
+            args = Selection(select, numbers)
+        except ValueError, e:
+            raise _BadRequest(str(e))
+    return options, args, param('part', int, 0)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /export?... streams a document, see _request_options.
+    GET /status returns the pool's status as JSON.
+    """
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address and self.client_address[0] or 'local'
+
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            print >> sys.stderr, '%s - [%s] %s' % (self.address_string(), self.log_date_time_string(), format % args)
+
+
+    def _reply(self, code, content_type, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/status':
+            self._reply(200, 'application/json')
+            json.dump(self.server.pool.status(), self.wfile)
+        elif url.path == '/export':
+            try:
+                options, args, part = _request_options(self.server.options, urlparse.parse_qs(url.query))
+            except _BadRequest, e:
+                self._reply(400, 'text/plain')
+                self.wfile.write('%s\n' % e)
+                return
+            self._export(options, args, part)
+        else:
+            self._reply(404, 'text/plain')
+            self.wfile.write('Not found, try /export or /status\n')
+
+
+    def _export(self, options, args, part):
+        pool = self.server.pool
+        logbook = pool.acquire()
+        generation = logbook.generation
+        try:
+            preferences = generation.preferences
+            if options.udcf:
+                # Streamed, so only the dive rows of the segments are read here.
+                plans = list(GDiveLogUDCF(logbook, options, preferences, args).iter_dives())
+            else:
+                xml = GDiveLogUDDF(logbook, options, preferences, args, catalogue=generation.catalogue, dive_cache=pool.dive_cache)
+                plans = xml.plan_segments()
+            if not 0 <= part < len(plans):
+                self._reply(400, 'text/plain')
+                self.wfile.write('No part %d, there are %d segments\n' % (part, len(plans)))
+                return
+            if options.udcf:
+                doc = plans[part]
+            else:
+                doc = xml.export_segment(plans[part])
+            self._reply(200, 'application/xml; charset=utf-8', {'X-Segments': len(plans)})
+            write_doc(self.wfile, doc, options.prettyprint)
+            if not options.udcf and generation.catalogue is None:
+                # Requests that started before this one was done build their own.
+                generation.catalogue = xml.catalogue
+        except socket.error, e:
+            print >> sys.stderr, 'Export for %s aborted: %s' % (self.address_string(), e)
+        finally:
+            pool.release(logbook)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(options):
+    """
+    Serve exports of options.gdivelog_db until interrupted.
+    options.serve is either a path for a Unix socket, or host:port (or
+    just port, on localhost) for HTTP.
+    """
+    address = options.serve
+    if '/' in address:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixHTTPServer(address, _Handler)
+    else:
+        host, port = 'localhost', address
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+        server = _HTTPServer((host, int(port)), _Handler)
+    server.options = options
+    server.pool = LogbookPool(options)
+    if options.verbose:
+        print >> sys.stderr, 'Serving %s on %s' % (options.gdivelog_db, address)
+    # Clean up on kill too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if '/' in address and os.path.exists(address):
+            os.unlink(address)
@@ -0,0 +1,227 @@
+"""
+Plain sqlite3 reader for gdivelog's sqlite db
+"""
+
+import sqlite3
+from collections import namedtuple
+from itertools import imap
+
+from gdivelog.logbook import Logbook, DiveContext, TABLES, PRAGMAS
+from gdivelog.instrument import NULL_INSTRUMENTATION
+
+
+__all__ = ['GDiveLogSQLite']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+def _row_type(name, table):
+    return namedtuple(name, dict(TABLES)[table])
+
+
+def _select(table, where=''):
+    return 'SELECT %s FROM %s %s' % (', '.join(dict(TABLES)[table]), table, where)
+
+
+def _in(column, values):
+    '''A "column IN (?, ...)" clause for values'''
+    return '%s IN (%s)' % (column, ', '.join('?' * len(values)))
+
+
+class GDiveLogSQLite(Logbook):
+    """
+    Reads gdivelog's sqlite db with the sqlite3 module, returning rows
+    as named tuples with the same attributes as GDiveLogDB's ORM
+    objects. Same interface and same rows in the same order as
+    GDiveLogDB, without the ORM's identity map and attribute
+    instrumentation, or importing SQLAlchemy.
+    """
+
+    Site = _row_type('Site', 'Site')
+    Dive = _row_type('Dive', 'Dive')
+    Buddy = _row_type('Buddy', 'Buddy')
+    DiveBuddy = _row_type('DiveBuddy', 'Dive_Buddy')
+    Equipment = _row_type('Equipment', 'Equipment')
+    DiveEquipment = _row_type('DiveEquipment', 'Dive_Equipment')
+    Tank = _row_type('Tank', 'Tank')
+    DiveTank = _row_type('DiveTank', 'Dive_Tank')
+    Sample = namedtuple('Sample', ('profile_time', 'profile_depth', 'profile_temperature'))
+    Mix = namedtuple('Mix', ('dive_tank_O2', 'dive_tank_He'))
+
+    def __init__(self, options, preferences, filename=None, instrument=NULL_INSTRUMENTATION):
+        """
+        Opens the logbook in options.gdivelog_db, or if filename is
+        given the already decompressed database in that file.
+
+        instrument is the Instrumentation to count queries and rows with.
+        """
+        Logbook.__init__(self, options, preferences, filename=filename, instrument=instrument)
+        # Only one thread at a time uses it, see release. In autocommit
+        # mode, as sqlite3 otherwise commits before the CREATE of a
+        # temporary table or index, resetting the queries in progress.
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+        self._index_tables()
+
+
+    def _execute(self, sql, params=()):
+        if self.instrument.enabled:
+            with self.instrument.query():
+                return self.connection.execute(sql, params)
+        return self.connection.execute(sql, params)
+
+
+    def _dbapi(self):
+        return self.connection
+
+
+    def _query(self, row_type, sql, params=()):
+        '''Iterate across the rows of sql as row_type'''
+        return self._rows(imap(row_type._make, self._execute(sql, params)))
+
+
+    def _where(self, numbers=None, ids=None, selection=None):
+        '''The WHERE clause for the dives in numbers or ids and selection'''
+        conditions = []
+        if numbers:
+            conditions.append('dive_number IN %s' % self._id_set(int(number) for number in numbers))
+        elif ids:
+            conditions.append('dive_id IN %s' % self._id_set(ids))
+        if selection is not None:
+            conditions.append(self.selected(selection))
+        if conditions:
+            return 'WHERE ' + ' AND '.join(conditions)
+        return ''
+
+
+    def dives(self, numbers=None, ids=None, orderby='number', selection=None):
+        """
+        Generator to iterate across dives in the database. Optionally only iterate across the ones listed in numbers,
+        or ids, and the ones selection selects.
+        """
+        # Ordered by number first like GDiveLogDB, whose order_by calls add up.
+        order = 'ORDER BY dive_number ASC'
+        if orderby == 'number':
+            order += ', dive_number ASC'
+        elif orderby == 'datetime':
+            order += ', dive_datetime ASC'
+        order += ', dive_id ASC'
+        return self._query(GDiveLogSQLite.Dive, _select('Dive', '%s %s' % (self._where(numbers, ids, selection), order)))
+
+
+    def dive_timeline(self, numbers=None, selection=None):
+        """
+        Generator yielding (dive_id, dive_datetime, site_id) for the
+        dives in numbers and selection, or all, in the order of
+        dives(orderby='datetime').
+        """
+        sql = ('SELECT dive_id, dive_datetime, site_id FROM Dive %s ORDER BY dive_number ASC, dive_datetime ASC, dive_id ASC'
+               % self._where(numbers, selection=selection))
+        return self._rows(self._execute(sql))
+
+
+    def dive_by_id(self, diveid):
+        for dive in self._query(GDiveLogSQLite.Dive, _select('Dive', 'WHERE dive_id = ?'), (diveid,)):
+            return dive
+        raise LookupError('No dive with id %d' % diveid)
+
+
+    def equipment(self, diveid=None):
+        """
+        Generator to iterate across equipment
+        """
+        if diveid:
+            return self._query(GDiveLogSQLite.DiveEquipment, _select('Dive_Equipment', 'WHERE dive_id = ?'), (diveid,))
+        return self._query(GDiveLogSQLite.Equipment, _select('Equipment'))
+
+
+    def buddies(self, diveid=None):
+        """
+        Generator to iterate across buddies in the database.
+        Optionally list buddies for a particular dive.
+        """
+        if not diveid:
+            return self._query(GDiveLogSQLite.Buddy, _select('Buddy'))
+        return self._query(GDiveLogSQLite.DiveBuddy, _select('Dive_Buddy', 'WHERE dive_id = ?'), (diveid,))
+
+
+    def samples(self, diveid):
+        sql = 'SELECT profile_time, profile_depth, profile_temperature FROM Profile WHERE dive_id = ? ORDER BY profile_time ASC'
+        return self._query(GDiveLogSQLite.Sample, sql, (diveid,))
+
+
+    def dive_tanks(self, diveid=None):
+        if diveid:
+            return self._query(GDiveLogSQLite.DiveTank, _select('Dive_Tank', 'WHERE dive_id = ?'), (diveid,))
+        return self._query(GDiveLogSQLite.DiveTank, _select('Dive_Tank'))
+
+
+    def dive_contexts(self, dives, window=None):
+        """
+        Generator yielding a DiveContext for each of the given dives, in
+        the same order. See GDiveLogDB.dive_contexts.
+        """
+        if window is None:
+            window = self.CONTEXT_WINDOW
+        tanks = dict((tank.tank_id, tank) for tank in self.tanks())
+
+        for start in range(0, len(dives), window):
+            contexts = [DiveContext(dive) for dive in dives[start:start + window]]
+            by_id = dict((context.dive.dive_id, context) for context in contexts)
+            ids = by_id.keys()
+            where = 'WHERE ' + _in('dive_id', ids)
+
+            for dive_tank in self._query(GDiveLogSQLite.DiveTank, _select('Dive_Tank', where), ids):
+                tank = tanks.get(dive_tank.tank_id)
+                if tank is None:
+                    tank = self.tank_by_id(dive_tank.tank_id)
+                by_id[dive_tank.dive_id].tanks.append((dive_tank, tank))
+            for buddy in self._query(GDiveLogSQLite.DiveBuddy, _select('Dive_Buddy', where), ids):
+                by_id[buddy.dive_id].buddies.append(buddy)
+            for equipment in self._query(GDiveLogSQLite.DiveEquipment, _select('Dive_Equipment', where), ids):
+                by_id[equipment.dive_id].equipment.append(equipment)
+            sql = ('SELECT dive_id, profile_time, profile_depth, profile_temperature FROM Profile %s ORDER BY dive_id ASC, profile_time ASC' % where)
+            for dive_id, time, depth, temperature in self._rows(self._execute(sql, ids)):
+                by_id[dive_id].samples.append(time, depth, temperature)
+
+            for context in contexts:
+                yield context
+
+
+    def mixes(self, ids=None, selection=None):
+        """
+        Generator to iterate across the distinct (dive_tank_O2,
+        dive_tank_He) mixes in Dive_Tank, in the order they're first
+        used. Optionally only the mixes used by the dives with the
+        given ids, or the dives selection selects.
+        """
+        if ids is not None and not ids:
+            return iter(())
+        sql = ('SELECT dive_tank_O2, dive_tank_He FROM Dive_Tank %s GROUP BY dive_tank_O2, dive_tank_He ORDER BY min(dive_tank_id)'
+               % self._where(ids=ids, selection=selection))
+        return self._query(GDiveLogSQLite.Mix, sql)
+
+
+    def tanks(self):
+        return self._query(GDiveLogSQLite.Tank, _select('Tank'))
+
+
+    def tank_by_id(self, tankid):
+        for tank in self._query(GDiveLogSQLite.Tank, _select('Tank', 'WHERE tank_id = ?'), (tankid,)):
+            return tank
+        raise LookupError('No tank with id %d' % tankid)
+
+
+    def sites(self):
+        """
+        Generator to iterate across dive sites.
+
+        Note, the site entries themselves are just fragments of
+        the entire site name. See site_name_list and site_name.
+        """
+        return self._query(GDiveLogSQLite.Site, _select('Site'))
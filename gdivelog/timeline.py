@@ -0,0 +1,152 @@
+"""
+The dives of an export in order, with their repetition groups, segments and trips
+"""
+
+import os.path
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice, izip
+
+from gdivelog import SI_INF
+
+
+__all__ = ['Timeline', 'Trip', 'group_trips']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+class Trip(object):
+    """
+    A <trip>; the ids of its dives in order, the common prefix of their
+    site names and the dates of the first and last dive.
+    """
+
+    __slots__ = ('dive_ids', 'name', 'startdate', 'enddate')
+
+    def __init__(self, dive_ids, name, startdate, enddate):
+        self.dive_ids = dive_ids
+        self.name = name
+        self.startdate = startdate
+        self.enddate = enddate
+
+
+def group_trips(db, dives, trip_si_threshold):
+    """
+    Group dives into trips, a new one starting with the first dive and
+    each dive after more than trip_si_threshold days at the surface.
+    Only looks at the site paths db has cached, no other queries.
+
+    Args;
+       db -- the Logbook, for site_name.
+       dives -- iterable of (dive_id, surfaceinterval, divetime, site_id) in order.
+       trip_si_threshold -- days.
+
+    Returns a list of Trip.
+    """
+    threshold = timedelta(days=trip_si_threshold)
+    groups = []
+    for dive in dives:
+        if not groups or dive[1] > threshold:
+            groups.append([dive])
+        else:
+            groups[-1].append(dive)
+
+    trips = []
+    for group in groups:
+        name = os.path.commonprefix([db.site_name(site_id) for dive_id, surfaceinterval, divetime, site_id in group])
+        trips.append(Trip([dive[0] for dive in group], name, group[0][2].date(), group[-1][2].date()))
+    return trips
+
+
+class Timeline(object):
+    """
+    The dives to export as columns of dive_id, datetime, site_id and
+    surface interval, in the order they're exported. Loaded with one
+    query, so the repetition groups, segments and trips can be planned
+    before any dive is generated.
+    """
+
+    def __init__(self, db, selection=None):
+        """
+        Args;
+           db -- the Logbook.
+           selection -- only the dives this Selection selects, as for db.dives.
+        """
+        self.db = db
+        self.dive_ids = array('l')
+        self.datetimes = []
+        self.site_ids = []
+        self.surfaceintervals = []
+        previous_divetime = datetime.min
+        for dive_id, dive_datetime, site_id in db.dive_timeline(selection=selection):
+            divetime = datetime.strptime(dive_datetime, '%Y-%m-%d %H:%M:%S')
+            self.dive_ids.append(dive_id)
+            self.datetimes.append(divetime)
+            self.site_ids.append(site_id)
+            self.surfaceintervals.append(divetime - previous_divetime)
+            previous_divetime = divetime
+
+
+    def __len__(self):
+        return len(self.dive_ids)
+
+
+    def segments(self, segment_size=None):
+        """
+        The documents to generate as (start, stop) index ranges. Once a
+        segment has segment_size dives it ends at the end of the
+        repetition group it's in, so every segment starts with a new
+        group. Without segment_size it's all in one.
+        """
+        ranges = []
+        start = 0
+        if segment_size:
+            for idx, surfaceinterval in enumerate(self.surfaceintervals):
+                if surfaceinterval >= SI_INF and idx - start >= segment_size:
+                    ranges.append((start, idx))
+                    start = idx
+        ranges.append((start, len(self)))
+        return ranges
+
+
+    def plan_segments(self, segment_size=None):
+        """
+        Returns a list of segments, each a list of (dive_id,
+        surfaceinterval, repetitiongroup_id), where repetitiongroup_id
+        is set for the dives that start a new <repetitiongroup>.
+        """
+        plans = []
+        counter = 1
+        for start, stop in self.segments(segment_size):
+            plan = []
+            for idx in xrange(start, stop):
+                repetitiongroup_id = None
+                if self.surfaceintervals[idx] >= SI_INF:
+                    repetitiongroup_id = counter
+                    counter += 1
+                plan.append((self.dive_ids[idx], self.surfaceintervals[idx], repetitiongroup_id))
+            plans.append(plan)
+        return plans
+
+
+    def trips(self, trip_si_threshold, start=0, stop=None):
+        '''The trips of the dives from index start to stop, see group_trips'''
+        if stop is None:
+            stop = len(self)
+        columns = (self.dive_ids, self.surfaceintervals, self.datetimes, self.site_ids)
+        return group_trips(self.db, izip(*[islice(column, start, stop) for column in columns]), trip_si_threshold)
+
+
+    def summary(self, segment_size=None, trip_si_threshold=None):
+        '''One line with the number of dives, repetition groups, segments and trips'''
+        segments = self.segments(segment_size)
+        groups = sum(1 for plan in self.plan_segments(segment_size) for dive_id, surfaceinterval, repetitiongroup_id in plan
+                     if repetitiongroup_id is not None)
+        line = '%d dives, %d repetition groups, %d segments' % (len(self), groups, len(segments))
+        if trip_si_threshold:
+            line += ', %d trips' % sum(len(self.trips(trip_si_threshold, start, stop)) for start, stop in segments)
+        return line
@@ -1,7 +1,14 @@
 from datetime import datetime
 import xml.dom.minidom
+import time
+from itertools import izip
 
 from gdivelog.utils import celcius_to_kelvin, celcius_to_fahrenheit, xml_add
+from gdivelog.writer import XMLStreamWriter
+from gdivelog.decimate import ProfileSimplifier
+from gdivelog.instrument import NULL_INSTRUMENTATION
+from gdivelog.selection import Selection
+from gdivelog.timeline import Timeline
 from gdivelog import SI_INF, NAME, VERSION
 
 __all__ = ['GDiveLogUDCF']
@@ -13,6 +20,58 @@ __version__ = "1.0"
 __status__ = "Production"
 
 
+_UDCF_ATTR = {'udcf': 1}
+
+
+class _SampleBlock(object):
+    """
+    The <t> and <d> elements for the samples of a dive, formatted in one
+    go from the columns of a Samples instead of building two minidom
+    elements per sample. The output is the same as for those elements.
+
+    Enough of a minidom node to be appended to an element, like uddf's
+    _WaypointBlock.
+    """
+
+    nodeType = xml.dom.Node.ELEMENT_NODE
+    parentNode = None
+    childNodes = ()
+
+    def __init__(self, samples, indices=None):
+        """
+        Args;
+           samples -- the dive's Samples.
+           indices -- optional list of the samples to write, eg. from a ProfileSimplifier.
+        """
+        self.samples = samples
+        self.indices = indices
+
+    def unlink(self):
+        self.samples = self.indices = None
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        sample = indent + '<t>%s</t>' + newl + indent + '<d>%s</d>' + newl
+        times, depths = self.samples.times, self.samples.depths
+        indices = self.indices
+        if indices is None:
+            indices = xrange(len(times))
+        writer.write(''.join([sample % (times[idx], depths[idx]) for idx in indices]))
+
+
+class _UDCFSegment(object):
+    """
+    One document of a UDCF export, generated while it is being written,
+    like uddf's _UDDFSegment.
+    """
+
+    def __init__(self, udcf, segment):
+        self.udcf = udcf
+        self.segment = segment
+
+    def writexml(self, writer, indent="", addindent="", newl="", encoding=None):
+        self.udcf._write_segment(XMLStreamWriter(writer, indent, addindent, newl), self.segment, encoding)
+
+
 class GDiveLogUDCF(object):
     """
     Represent a GDivelog database as a UDCF document.
@@ -20,14 +79,22 @@ class GDiveLogUDCF(object):
     Note: UDCF is discontinued, so don't bother putting too much effort into this thing.
     """
 
-    def __init__(self, divelog, options, preferences, args):
+    def __init__(self, divelog, options, preferences, args, instrument=NULL_INSTRUMENTATION):
         self.divelog = divelog
         self.options = options
         self.preferences = preferences
-        self.args = args
+        self.selection = Selection.of(args)
+        self.instrument = instrument
+        self.simplifier = None
+        if options.max_samples or options.tolerance is not None:
+            self.simplifier = ProfileSimplifier(options.max_samples, options.tolerance)
+        if instrument.enabled:
+            self._add = instrument.counted(self._add, 'nodes')
+
+    def _start_new_doc(self):
         self.top = xml.dom.minidom.Document()
         # Put in the <generator> header.
-        self.doc = self._add(self.top, 'profile', attr={'udcf': 1})
+        self.doc = self._add(self.top, 'profile', attr=_UDCF_ATTR)
         if self.preferences.depth_unit == 'm':
             self._add(self.doc, 'units', text='Metric')
         else:
@@ -39,55 +106,124 @@ class GDiveLogUDCF(object):
         return xml_add(self.top, node, tag, text=text, subfields=subfields, attr=attr)
 
 
-    def iter_dives(self):
+    def _iter_segments(self):
         """
-        Add all known dives to the UDCF document.
-        """
-        previous_divetime = datetime.min
-        group = self._add(self.doc, 'repgroup')
+        Split the dives into the documents to generate, the same
+        way as for UDDF, see Timeline.segments.
 
-        for dive in self.divelog.dives(numbers=self.args):
-            # Compute the SI and start a new group if INF
-            divetime = datetime.strptime(dive.dive_datetime, '%Y-%m-%d %H:%M:%S')
-            surfaceinterval = divetime - previous_divetime
-            dive_group = self._add(group, 'dive')
+        Each segment is a list of (dive, surfaceinterval).
+        """
+        timeline = Timeline(self.divelog, self.selection)
+        dives = self.divelog.dives(selection=self.selection)
+        for start, stop in timeline.segments(int(self.options.segment_size or 0)):
+            # Same order as the timeline, so the range comes first not to drop a dive.
+            yield [(dive, timeline.surfaceintervals[idx]) for idx, dive in izip(xrange(start, stop), dives)]
 
-            self._add(dive_group, 'date', subfields={'year': divetime.year, 'month': divetime.month, 'day': divetime.day})
-            self._add(dive_group, 'time', subfields={'hour': divetime.hour, 'minute': divetime.minute})
 
-            if surfaceinterval > SI_INF:
-                self._add(dive_group, 'surface_interval', subfields={'infinity': None})
-            else:
-                self._add(dive_group, 'surface_interval', subfields={'passedtime': surfaceinterval.days * 24 * 60 * 60 + surfaceinterval.seconds}) # .total_seconds in 2.7...
+    def _add_dive(self, group, surfaceinterval, context):
+        """
+        Add a <dive> to group for the dive and samples in the
+        DiveContext context, returns the <dive> element.
+        """
+        dive = context.dive
+        divetime = datetime.strptime(dive.dive_datetime, '%Y-%m-%d %H:%M:%S')
+        dive_group = self._add(group, 'dive')
 
-            if celcius_to_kelvin(dive.dive_mintemp) > 0:
-                if self.preferences.depth_unit == 'm':
-                    self._add(dive_group, 'temperature', dive.dive_mintemp)
-                else:
-                    self._add(dive_group, 'temperature', celcius_to_fahrenheit(dive.dive_mintemp))
-            self._add(dive_group, 'density', text=1030.0)
-            self._add(dive_group, 'altitude', text=0.0)
+        self._add(dive_group, 'date', subfields={'year': divetime.year, 'month': divetime.month, 'day': divetime.day})
+        self._add(dive_group, 'time', subfields={'hour': divetime.hour, 'minute': divetime.minute})
 
-            # FIXME:...
-            gases_group = self._add(dive_group, 'gases')
-            mix_group = self._add(gases_group, 'mix', subfields={'mixname': 1, 'o2': 0.21, 'n2': 0.79, 'he': 0.0})
-            tank_group = self._add(mix_group, 'tank', subfields={'tankvolume': 10, 'pstart': 250, 'pend': 30})
+        if surfaceinterval > SI_INF:
+            self._add(dive_group, 'surface_interval', subfields={'infinity': None})
+        else:
+            self._add(dive_group, 'surface_interval', subfields={'passedtime': surfaceinterval.days * 24 * 60 * 60 + surfaceinterval.seconds}) # .total_seconds in 2.7...
 
-            if dive.site_id > 0:
-                self._add(dive_group, 'place', text=self.divelog.site_name(dive.site_id))
+        if celcius_to_kelvin(dive.dive_mintemp) > 0:
+            if self.preferences.depth_unit == 'm':
+                self._add(dive_group, 'temperature', dive.dive_mintemp)
+            else:
+                self._add(dive_group, 'temperature', celcius_to_fahrenheit(dive.dive_mintemp))
+        self._add(dive_group, 'density', text=1030.0)
+        self._add(dive_group, 'altitude', text=0.0)
+
+        # FIXME:...
+        gases_group = self._add(dive_group, 'gases')
+        mix_group = self._add(gases_group, 'mix', subfields={'mixname': 1, 'o2': 0.21, 'n2': 0.79, 'he': 0.0})
+        self._add(mix_group, 'tank', subfields={'tankvolume': 10, 'pstart': 250, 'pend': 30})
+
+        if dive.site_id > 0:
+            self._add(dive_group, 'place', text=self.divelog.site_name(dive.site_id))
+
+        self._add(dive_group, 'timedepthmode')
+        sample_group = self._add(dive_group, 'samples', subfields={'switch': 1})
+        self._add(sample_group, 't', text=0)
+        self._add(sample_group, 'd', text=0)
+        samples = context.samples
+        indices = None
+        if self.simplifier:
+            indices = self.simplifier(samples.times, samples.depths, samples.temperatures)
+        if samples:
+            sample_group.appendChild(_SampleBlock(samples, indices))
+        self._add(sample_group, 't')
+        self._add(sample_group, 'd', text=0)
+        if self.instrument.enabled:
+            self.instrument.count('waypoints', len(indices) if indices is not None else len(samples))
+        return dive_group
+
+
+    def _build_segment(self, segment):
+        """
+        Build the minidom document for a segment.
+        """
+        self._start_new_doc()
+        group = self._add(self.doc, 'repgroup')
+        contexts = self.divelog.dive_contexts([dive for dive, surfaceinterval in segment])
+        for (dive, surfaceinterval), context in izip(segment, contexts):
+            if self.instrument.enabled:
+                start = time.time()
+            self._add_dive(group, surfaceinterval, context)
+            if self.instrument.enabled:
+                self.instrument.dive(dive.dive_id, time.time() - start)
+        return self.top
 
-            self._add(dive_group, 'timedepthmode')
-            sample_group = self._add(dive_group, 'samples', subfields={'switch': 1})
-            self._add(sample_group, 't', text=0)
-            self._add(sample_group, 'd', text=0)
-            for sample in self.divelog.samples(dive.dive_id):
-                self._add(sample_group, 't', text=sample.profile_time)
-                self._add(sample_group, 'd', text=sample.profile_depth)
-            self._add(sample_group, 't')
-            self._add(sample_group, 'd', text=0)
 
-            previous_divetime = divetime
+    def _write_segment(self, out, segment, encoding):
+        """
+        Write the document for a segment to the XMLStreamWriter out as
+        it is generated, a single dive at a time.
+        """
+        self._start_new_doc()
+        out.start_document(encoding)
+        out.start('profile', attr=_UDCF_ATTR)
+        for node in self.doc.childNodes:
+            out.node(node)
+
+        # Scratch element to hang the nodes off while they're written.
+        scratch = self.top.createElement('scratch')
+
+        out.start('repgroup')
+        contexts = self.divelog.dive_contexts([dive for dive, surfaceinterval in segment])
+        for (dive, surfaceinterval), context in izip(segment, contexts):
+            if self.instrument.enabled:
+                start = time.time()
+            dive_group = self._add_dive(scratch, surfaceinterval, context)
+            scratch.removeChild(dive_group)
+            out.node(dive_group)
+            dive_group.unlink()
+            if self.instrument.enabled:
+                self.instrument.dive(dive.dive_id, time.time() - start)
+        out.close()
 
-        yield self.top
 
+    def iter_dives(self):
+        """
+        Add all known dives to the UDCF document.
 
+        Yields a minidom document per segment, or with --stream an
+        object with the same writexml that generates the document as
+        it is written.
+        """
+        for segment in self._iter_segments():
+            if self.options.stream:
+                yield _UDCFSegment(self, segment)
+            else:
+                yield self._build_segment(segment)
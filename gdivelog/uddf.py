@@ -1,9 +1,20 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import xml.dom.minidom
+import os
 import sys
-import os.path
+import time
+import hashlib
+from StringIO import StringIO
+from bisect import bisect_left
+from itertools import izip
 
 from gdivelog.utils import celcius_to_kelvin, celcius_to_fahrenheit, xml_add
+from gdivelog.writer import XMLStreamWriter, escape
+from gdivelog.decimate import ProfileSimplifier
+from gdivelog.instrument import NULL_INSTRUMENTATION
+from gdivelog.timeline import Timeline, group_trips
+from gdivelog.selection import Selection
+from gdivelog.divecache import DiveCache
 from gdivelog import SI_INF, NAME, VERSION
 
 __all__ = ['GDiveLogUDDF']
@@ -69,24 +80,254 @@ def _volume_for_tank(preferences, tank):
     return volume
 
 
+_UDDF_ATTR = {'version': '3.0.0', 'type': 'converter'}
+
+# The modules a <dive> is rendered with. A digest of their source is
+# part of every DiveCache key, so dives rendered by another version of
+# them are never used.
+_RENDERER_MODULES = ('gdivelog.uddf', 'gdivelog.utils', 'gdivelog.writer', 'gdivelog.decimate')
+_renderer_digest = None
+
+
+def _renderer_source_digest():
+    """
+    The sha1 of the source of _RENDERER_MODULES, read once per process.
+    Raises IOError if one can't be read.
+    """
+    global _renderer_digest
+    if _renderer_digest is None:
+        digest = hashlib.sha1()
+        for name in _RENDERER_MODULES:
+            path = sys.modules[name].__file__
+            if path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+                path = path[:-1]
+            with open(path, 'rb') as source:
+                digest.update(source.read())
+        _renderer_digest = digest.hexdigest()
+    return _renderer_digest
+
+
+class _WaypointBlock(object):
+    """
+    All the <waypoint> elements of a dive's <samples>, formatted in
+    one go from the columns of a Samples instead of building a minidom
+    element per waypoint. The output is the same as for those elements.
+
+    Enough of a minidom node to be appended to an element and written
+    with it, or written on its own with XMLStreamWriter.node.
+    """
+
+    nodeType = xml.dom.Node.ELEMENT_NODE
+    parentNode = None
+    childNodes = ()
+
+    def __init__(self, samples, mix_switch_times, simplifier=None):
+        """
+        Args;
+           samples -- the dive's Samples.
+           mix_switch_times -- sorted list of (starttime, mixref). Each is placed
+              on the first waypoint at or after starttime that doesn't
+              already have a switch.
+           simplifier -- optional ProfileSimplifier to drop waypoints with.
+              The ones with a mix switch are kept.
+        """
+        self.samples = samples
+        # FIXME: check temperature units
+        self.kelvins = map(celcius_to_kelvin, samples.temperatures)
+        self.switches = {}
+        idx = 0
+        for starttime, ref in mix_switch_times:
+            idx = max(idx, bisect_left(samples.times, starttime))
+            if idx >= len(samples):
+                break
+            self.switches[idx] = escape(ref)
+            idx += 1
+        self.indices = None
+        if simplifier:
+            self.indices = simplifier(samples.times, samples.depths, samples.temperatures, pinned=self.switches)
+
+    def __len__(self):
+        '''The number of <waypoint> elements written'''
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.samples)
+
+    def unlink(self):
+        self.samples = self.kelvins = self.switches = self.indices = None
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        inner = indent + addindent
+        waypoint = (indent + '<waypoint>' + newl +
+                    inner + '<divetime>%r</divetime>' + newl +
+                    inner + '<depth>%r</depth>' + newl)
+        switchmix = inner + '<switchmix ref="%s"/>' + newl
+        temperature = inner + '<temperature>%s</temperature>' + newl
+        end = indent + '</waypoint>' + newl
+
+        block = []
+        switches = self.switches
+        times, depths, kelvins = self.samples.times, self.samples.depths, self.kelvins
+        indices = self.indices
+        if indices is None:
+            indices = xrange(len(times))
+        for idx in indices:
+            k = kelvins[idx]
+            block.append(waypoint % (times[idx], depths[idx]))
+            if idx in switches:
+                block.append(switchmix % switches[idx])
+            if k > 0:
+                block.append(temperature % k)
+            block.append(end)
+        writer.write(''.join(block))
+
+
+class _RenderedNode(object):
+    """
+    A minidom element that's built once and written in every document,
+    like the <site> elements. Its text is rendered the first time it's
+    written at an indent, and the same text written after that.
+
+    Enough of a minidom node to be appended to an element, like
+    _WaypointBlock. A node only has one parent, so use copy to put it
+    in each document.
+    """
+
+    nodeType = xml.dom.Node.ELEMENT_NODE
+    parentNode = None
+    childNodes = ()
+
+    def __init__(self, element, renders=None):
+        self.element = element
+        # (indent, addindent, newl) -> text, shared by the copies.
+        self.renders = renders if renders is not None else {}
+
+    def copy(self):
+        return _RenderedNode(self.element, self.renders)
+
+    def unlink(self):
+        # The element is shared with the other copies.
+        pass
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        key = (indent, addindent, newl)
+        text = self.renders.get(key)
+        if text is None:
+            rendered = StringIO()
+            self.element.writexml(rendered, indent, addindent, newl)
+            text = self.renders[key] = rendered.getvalue()
+        writer.write(text)
+
+
+class _CachedDive(object):
+    """
+    A <dive> element written from the DiveCache, or rendered and added
+    to it if it isn't there for the indent it's written at, see
+    GDiveLogUDDF._cached_dive.
+
+    Enough of a minidom node to be appended to an element and written
+    with it, or written on its own with XMLStreamWriter.node, like
+    _WaypointBlock.
+    """
+
+    nodeType = xml.dom.Node.ELEMENT_NODE
+    parentNode = None
+    childNodes = ()
+
+    def __init__(self, uddf, surfaceinterval, context):
+        self.uddf = uddf
+        self.surfaceinterval = surfaceinterval
+        self.context = context
+
+    def unlink(self):
+        self.uddf = self.context = None
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        writer.write(self.uddf._cached_dive(self.surfaceinterval, self.context, indent, addindent, newl))
+
+
+class _UDDFSegment(object):
+    """
+    One segment of a UDDF export, generated while it is being written.
+
+    Has the same writexml as a minidom Document, so it can be written
+    the same way, but never holds more than a single dive in memory.
+    """
+
+    def __init__(self, uddf, segment):
+        self.uddf = uddf
+        self.segment = segment
+
+    def writexml(self, writer, indent="", addindent="", newl="", encoding=None):
+        self.uddf._write_segment(XMLStreamWriter(writer, indent, addindent, newl), self.segment, encoding)
+
+
 class GDiveLogUDDF(object):
     """
     Represent a GDivelog database as a UDDF document.
     """
 
-    def __init__(self, db, options, preferences, args):
+    def __init__(self, db, options, preferences, args, instrument=NULL_INSTRUMENTATION, catalogue=None, dive_cache=None):
+        """
+        Args;
+           catalogue -- the catalogue of an earlier GDiveLogUDDF on the
+              same logbook and preferences, to use instead of building it again.
+           dive_cache -- an open DiveCache to use with --dive-cache-dir,
+              instead of opening one.
+        """
         self.db = db
         self.options = options
         self.preferences = preferences
-        self.args = args
-        self._start_new_doc()
+        self.selection = Selection.of(args)
+        self.instrument = instrument
+        self._timeline = None
+        self._catalogue = catalogue
+        self.simplifier = None
+        if options.max_samples or options.tolerance is not None:
+            self.simplifier = ProfileSimplifier(options.max_samples, options.tolerance)
+        self.dive_cache = None
+        if options.dive_cache_dir:
+            try:
+                # What besides the dive's rows and surface interval goes into a <dive>.
+                self._dive_settings = repr((_renderer_source_digest(), VERSION, preferences.volume_unit, preferences.pressure_unit,
+                                            options.max_samples, options.tolerance))
+                if dive_cache is None:
+                    dive_cache = DiveCache(options.dive_cache_dir, options.dive_cache_size * 1024 * 1024, verbose=options.verbose)
+                self.dive_cache = dive_cache
+            except IOError, e:
+                if options.verbose:
+                    print >> sys.stderr, 'Not using the dive cache: %s' % e
+            # Nodes made, for the counts cached with each dive, see _render_dive.
+            self._nodes = 0
+            self._add = self._counted(self._add)
+        if instrument.enabled:
+            self._add = instrument.counted(self._add, 'nodes')
+
+    @property
+    def catalogue(self):
+        """
+        The <diver> and <divesite> entries, see _catalogue_entries, or
+        None if no document has been started yet. Only depends on the
+        logbook and preferences, not the options, and isn't changed
+        after it's built, so exports running at the same time can share it.
+        """
+        return self._catalogue
+
+    @property
+    def timeline(self):
+        '''The Timeline of the dives to export, loaded on first use'''
+        if self._timeline is None:
+            self._timeline = Timeline(self.db, self.selection)
+        return self._timeline
 
-    def _start_new_doc(self):
+
+    def _start_new_doc(self, references=None):
+        """
+        Start a document with the <generator>, <diver> and <divesite>
+        sections. With references, from _segment_references, only the
+        sites, buddies, equipment and tanks in it are included.
+        """
         self.top = xml.dom.minidom.Document()
-        self.doc = self._add(self.top, 'uddf',
-                             attr={'version': '3.0.0',
-                                   'type': 'converter'}
-                             )
+        self.doc = self._add(self.top, 'uddf', attr=_UDDF_ATTR)
         generator = self._add(self.doc, 'generator', subfields={'name': NAME,
                                                                 'version': VERSION,
                                                                 'type': 'logbook'}
@@ -96,9 +337,15 @@ class GDiveLogUDDF(object):
         self._add(contact, 'homepage', 'http://github.com/eskil/gdivelog2uddf')
         self._add(contact, 'homepage', 'http://eskil.org/')
         self._add(generator, 'datetime', datetime.now().isoformat())
-        # Instead, like dive_trips, we should track the eq and sites needed per segment.
-        self._add_divers_and_equipment()
-        self._add_sites()
+        self._add_divers_and_equipment(references)
+        self._add_sites(references)
+
+    def _counted(self, function):
+        '''Wrap function to count its calls in _nodes'''
+        def wrapper(*args, **kwargs):
+            self._nodes += 1
+            return function(*args, **kwargs)
+        return wrapper
 
     def _add(self, node, tag, text=None, subfields={}, attr={}):
         '''Helper function to add tag to node via xml_add'''
@@ -129,80 +376,129 @@ class GDiveLogUDDF(object):
             self._add(group, 'para', text=line)
 
 
-    def _add_divers_and_equipment(self):
+    def _catalogue_entries(self):
         """
-        Add the divelog owner and all known buddies to the UDDF document.
+        The equipment, tanks, buddies and sites as {table: [(id,
+        _RenderedNode)]} in db order. Built once per run, or given to
+        the constructor, so the db isn't read and the notes aren't
+        parsed again for every segment.
         """
-        divers = self._add(self.doc, 'diver')
-        owner = self._add(divers, 'owner', attr={'id': 'owner'})
-        self._add(owner, 'personal', subfields={'firstname': 'Your First Name', 'lastname': 'Your Last Name'})
-        equipment_group = self._add(owner, 'equipment')
+        if self._catalogue is not None:
+            return self._catalogue
+        # The entries are built on a scratch element and taken off it.
+        scratch = self.top.createElement('scratch')
+        catalogue = dict((table, []) for table in ('Equipment', 'Tank', 'Buddy', 'Site'))
+        def entry(table, row_id, element):
+            scratch.removeChild(element)
+            catalogue[table].append((row_id, _RenderedNode(element)))
 
         for equipment in self.db.equipment():
-            piece_group = self._add(equipment_group, 'variouspieces', subfields={'name': equipment.equipment_name}, attr={'id': _equipment_ref(equipment.equipment_id)})
+            piece_group = self._add(scratch, 'variouspieces', subfields={'name': equipment.equipment_name}, attr={'id': _equipment_ref(equipment.equipment_id)})
 
             self._add_text_paragraphs(piece_group, 'notes', equipment.equipment_notes)
+            entry('Equipment', equipment.equipment_id, piece_group)
         for tank in self.db.tanks():
-            piece_group = self._add(equipment_group, 'tank', subfields={'name': tank.tank_name}, attr={'id': _tank_ref(tank.tank_id)})
+            piece_group = self._add(scratch, 'tank', subfields={'name': tank.tank_name}, attr={'id': _tank_ref(tank.tank_id)})
             self._add(piece_group, 'volume', _volume_for_tank(self.preferences, tank))
             self._add_text_paragraphs(piece_group, 'notes', tank.tank_notes)
+            entry('Tank', tank.tank_id, piece_group)
 
         for buddy in self.db.buddies():
-            buddy_group = self._add(divers, 'buddy', attr={'id': _buddy_ref(buddy.buddy_id)})
+            buddy_group = self._add(scratch, 'buddy', attr={'id': _buddy_ref(buddy.buddy_id)})
             names = buddy.buddy_name.split(' ')
             self._add(buddy_group, 'personal', subfields={'firstname': names[0], 'lastname': ' '.join(names[1:])})
             self._add_text_paragraphs(buddy_group, 'notes', buddy.buddy_notes)
+            entry('Buddy', buddy.buddy_id, buddy_group)
+
+        for site in self.db.sites():
+            site_group = self._add(scratch, 'site', subfields={'name': self.db.site_name(site.site_id)}, attr={'id': _site_ref(site.site_id)})
+            self._add_text_paragraphs(site_group, 'notes', site.site_notes)
+            entry('Site', site.site_id, site_group)
+
+        self._catalogue = catalogue
+        return catalogue
+
+
+    def _add_catalogue(self, node, table, references):
+        '''Add the entries of table from _catalogue_entries to node, or the ones in references'''
+        for row_id, rendered in self._catalogue_entries()[table]:
+            if references is None or row_id in references[table]:
+                node.appendChild(rendered.copy())
+
 
+    def _add_divers_and_equipment(self, references=None):
+        """
+        Add the divelog owner and all known buddies to the UDDF
+        document, or the ones in references.
+        """
+        divers = self._add(self.doc, 'diver')
+        owner = self._add(divers, 'owner', attr={'id': 'owner'})
+        self._add(owner, 'personal', subfields={'firstname': 'Your First Name', 'lastname': 'Your Last Name'})
+        equipment_group = self._add(owner, 'equipment')
+        self._add_catalogue(equipment_group, 'Equipment', references)
+        self._add_catalogue(equipment_group, 'Tank', references)
+        self._add_catalogue(divers, 'Buddy', references)
 
-    def _add_sites(self):
+
+    def _add_sites(self, references=None):
         """
-        Add all known sites to the UDDF document.
+        Add all known sites to the UDDF document, or the ones in references.
 
         The GDivelog "tree" is lost, since each divesite is formed
         by walking the list of parents and combining using the
         site name seperator.
         """
         divesites = self._add(self.doc, 'divesite')
-        for site in self.db.sites():
-            site_group = self._add(divesites, 'site', subfields={'name': self.db.site_name(site.site_id)}, attr={'id': _site_ref(site.site_id)})
-            self._add_text_paragraphs(site_group, 'notes', site.site_notes)
+        self._add_catalogue(divesites, 'Site', references)
 
 
-    def _add_divetrips(self, dive_trips):
+    def _segment_trips(self, segment):
         """
-        Add all divetrip to the UDDF document
+        The trips of the dives in segment as a list of Trip, or None
+        without --trip-threshold. A segment may start in the middle of
+        a trip, its first dive always starts one.
         """
         if not self.options.trip_si_threshold:
-            return
+            return None
+        dives = ((dive.dive_id, surfaceinterval, datetime.strptime(dive.dive_datetime, '%Y-%m-%d %H:%M:%S'), dive.site_id)
+                 for dive, surfaceinterval, repititiongroup_id in segment)
+        return group_trips(self.db, dives, self.options.trip_si_threshold)
 
-        divetrips = self._add(self.doc, 'divetrip')
-        previous_divetime = datetime.min
-        trip_counter = 1
 
-        for trip_id, dive_ids in enumerate(dive_trips):
+    def _add_divetrips(self, trips):
+        """
+        Add all divetrip to the UDDF document, for the list of Trip
+        from _segment_trips.
+        """
+        if trips is None:
+            return None
+
+        divetrips = self._add(self.doc, 'divetrip')
+        for trip_id, dive_trip in enumerate(trips):
             trip = self._add(divetrips, 'trip', attr={'id': _trip_ref(trip_id)})
-            dives = [dive for dive in self.db.dives(ids=dive_ids, orderby='datetime')]
-            first_dive = dives[0]
-            last_dive = dives[-1]
-            site_name = os.path.commonprefix([self.db.site_name(dive.site_id) for dive in dives])
-            self._add(trip, 'name', site_name)
+            self._add(trip, 'name', dive_trip.name)
             trippart = self._add(trip, 'trippart')
-            self._add(trippart, 'dateoftrip', attr={'startdate': datetime.strptime(first_dive.dive_datetime, '%Y-%m-%d %H:%M:%S').date().isoformat(), 'enddate': datetime.strptime(last_dive.dive_datetime, '%Y-%m-%d %H:%M:%S').date().isoformat()})
+            self._add(trippart, 'dateoftrip', attr={'startdate': dive_trip.startdate.isoformat(), 'enddate': dive_trip.enddate.isoformat()})
             relateddives = self._add(trippart, 'relateddives')
-            for dive_id in dive_ids:
+            for dive_id in dive_trip.dive_ids:
                 self._add(relateddives, 'link', attr={'ref': _dive_ref(dive_id)})
+        return divetrips
 
 
-    def _add_gasdefinitions(self, gasdefinitions, dive):
+    def _add_gasdefinitions(self, dive_ids):
         """
-        Add all known gas definitions to the UDDF document
+        Add the gas definitions for the mixes used by the dives with
+        the given ids to the UDDF document, or by all the selected
+        dives if dive_ids is None.
         """
+        gasdefinitions = self._add(self.doc, 'gasdefinitions')
         # Also create a dict {diveid: [(dive_tank_stime, dive_tank_id)]}.
         # This way, while creating waypoints, lookup the list and when then
         # divetime field crosses the dive_tank_stime, lookup the dive_tank_id,
         # add a <tankdata> field to the dive, and a <switchmix> field to the <waypoint>
         cache = set()
-        for dive_tank in self.db.dive_tanks():
+        # Different O2/He values may still give the same ref, first one wins.
+        for dive_tank in self.db.mixes(ids=dive_ids, selection=self.selection):
             ref = _mix_ref(dive_tank)
             if ref not in cache:
                 mix_group = self._add(gasdefinitions, 'mix', attr={'id': ref})
@@ -220,23 +516,23 @@ class GDiveLogUDDF(object):
         if not cache or not 'mix_air' in cache:
             mix_group = self._add(gasdefinitions, 'mix', attr={'id': 'mix_air'})
             self._add(mix_group, 'o2', 0.209)
+        return gasdefinitions
 
 
-    def _add_dive(self, repititongroup, surfaceinterval, dive, dive_trips):
+    def _add_dive(self, repititongroup, surfaceinterval, context):
         """
-        This adds a single <dive> tag to the <repetitiongroup> given.
+        This adds a single <dive> tag to the <repetitiongroup> given,
+        using the dive and rows in the DiveContext context.
+
+        The <samples> are left out, see _WaypointBlock. Returns the
+        <dive> element and the list of mix switches for the waypoints.
         """
+        dive = context.dive
         divetime = datetime.strptime(dive.dive_datetime, '%Y-%m-%d %H:%M:%S')
         dive_group = self._add(repititongroup, 'dive', attr={'id': _dive_ref(dive.dive_id)})
         pre_info_group = self._add(dive_group, 'informationbeforedive')
         post_info_group = self._add(dive_group, 'informationafterdive')
         self._add(pre_info_group, 'dive_number', text=dive.dive_number)
-        if self.options.trip_si_threshold:
-            if surfaceinterval > timedelta(days=self.options.trip_si_threshold):
-                dive_trips.append([dive.dive_id])
-            else:
-                dive_trips[-1].append(dive.dive_id)
-
         self._add(pre_info_group, 'datetime', divetime.isoformat())
         if surfaceinterval > SI_INF:
             self._add(pre_info_group, 'surfaceintervalbeforedive', subfields={'infinity': None})
@@ -256,13 +552,12 @@ class GDiveLogUDDF(object):
 
         # mix_switch_times is a list of (starttime, mixref), so while traversing dive times for the waypoint samples, we can pop off elements as switches are made.
         mix_switch_times = []
-        for dive_tank in self.db.dive_tanks(diveid=dive.dive_id):
+        for dive_tank, tank in context.tanks:
             if dive_tank.dive_tank_stime >= 0 and dive_tank.dive_tank_etime > 0:
                 mix_switch_times.append((dive_tank.dive_tank_stime, _mix_ref(dive_tank)))
             tank_group = self._add(dive_group, 'tankdata')
             self._add(tank_group, 'link', attr={'ref': _tank_ref(dive_tank.tank_id)})
             self._add(tank_group, 'link', attr={'ref': _mix_ref(dive_tank)})
-            tank = self.db.tank_by_id(dive_tank.tank_id)
             self._add(tank_group, 'volume', _volume_for_tank(self.preferences, tank))
             # FIXME: convert to pascal
             self._add(tank_group, 'tankpressurebegin', dive_tank.dive_tank_spressure)
@@ -280,72 +575,257 @@ class GDiveLogUDDF(object):
         if dive.site_id > 0:
             self._add(dive_group, 'link', attr={'ref': _site_ref(dive.site_id)})
 
-        for buddy in self.db.buddies(diveid=dive.dive_id):
+        for buddy in context.buddies:
             self._add(dive_group, 'link', attr={'ref': _buddy_ref(buddy.buddy_id)})
 
         equipment_group = self._add(dive_group, 'equipmentused')
         if dive.dive_weight > 0.0:
             self._add(equipment_group, 'leadquantity', dive.dive_weight)
-        for equipment in self.db.equipment(diveid=dive.dive_id):
+        for equipment in context.equipment:
             self._add(equipment_group, 'link', attr={'ref': _equipment_ref(equipment.equipment_id)})
 
+        return dive_group, mix_switch_times
+
+
+    def _dive_key(self, surfaceinterval, context):
+        """
+        A sha1 of everything the <dive> for context is made from, for
+        the DiveCache. _CachedDive adds the indent.
+        """
+        digest = hashlib.sha1(self._dive_settings)
+        if surfaceinterval > SI_INF:
+            digest.update('infinity')
+        else:
+            digest.update('%d' % (surfaceinterval.days * 24 * 60 * 60 + surfaceinterval.seconds))
+        context.update_digest(digest)
+        return digest
+
+
+    def _render_dive(self, surfaceinterval, context, indent, addindent, newl):
+        """
+        The text of the <dive> for context with its <samples>, as
+        writexml writes it at indent. Returns (text, counts), counts
+        being the profile samples the simplifier took in and kept, the
+        waypoints and the nodes made, for _cached_dive.
+        """
+        nodes = self._nodes
+        if self.simplifier:
+            samples_in, samples_out = self.simplifier.samples_in, self.simplifier.samples_out
+        scratch = self.top.createElement('scratch')
+        dive_group, mix_switch_times = self._add_dive(scratch, surfaceinterval, context)
         sample_group = self._add(dive_group, 'samples')
-        for sample in self.db.samples(dive.dive_id):
-            waypoint = self._add(sample_group, 'waypoint', subfields={'divetime': sample.profile_time, 'depth': sample.profile_depth})
-            if mix_switch_times and sample.profile_time >= mix_switch_times[0][0]:
-                self._add(waypoint, 'switchmix', attr={'ref': mix_switch_times[0][1]})
-                mix_switch_times.pop(0)
-            # FIXME: check temperature units
-            k = celcius_to_kelvin(sample.profile_temperature)
-            if k > 0:
-                self._add(waypoint, 'temperature', k)
+        waypoints = 0
+        if context.samples:
+            block = self._waypoints(context, mix_switch_times)
+            sample_group.appendChild(block)
+            waypoints = len(block)
+        rendered = StringIO()
+        dive_group.writexml(rendered, indent, addindent, newl)
+        dive_group.unlink()
+        counts = (0, 0)
+        if self.simplifier:
+            counts = (self.simplifier.samples_in - samples_in, self.simplifier.samples_out - samples_out)
+        return rendered.getvalue(), counts + (waypoints, self._nodes - nodes)
+
+
+    def _cached_dive(self, surfaceinterval, context, indent, addindent, newl):
+        """
+        The text of the <dive> for context at indent from the
+        DiveCache, rendered and added to it if it isn't there. A dive
+        from the cache adds the counts it was rendered with to the
+        simplifier and the instrumentation, so the reports are the same
+        as without the cache. The time recorded for the dive is that of
+        hashing it and getting or rendering it.
+        """
+        if self.instrument.enabled:
+            start = time.time()
+        digest = self._dive_key(surfaceinterval, context)
+        digest.update(repr((indent, addindent, newl)))
+        key = digest.hexdigest()
+        cached = self.dive_cache.get(key)
+        if cached is None:
+            text, counts = self._render_dive(surfaceinterval, context, indent, addindent, newl)
+            self.dive_cache.put(key, text, counts)
+        else:
+            text, (samples_in, samples_out, waypoints, nodes) = cached
+            if self.simplifier:
+                self.simplifier.add_counts(samples_in, samples_out)
+            if self.instrument.enabled:
+                self.instrument.count('cached dives')
+                self.instrument.count('waypoints', waypoints)
+                self.instrument.count('nodes', nodes)
+        if self.instrument.enabled:
+            self.instrument.dive(context.dive.dive_id, time.time() - start)
+        return text
+
+
+    def _waypoints(self, context, mix_switch_times):
+        '''The _WaypointBlock with the <samples> of the dive in context'''
+        block = _WaypointBlock(context.samples, mix_switch_times, self.simplifier)
+        if self.instrument.enabled:
+            self.instrument.count('waypoints', len(block))
+        return block
+
+
+    def _iter_segments(self):
+        """
+        Split the dives into the documents to generate. Without
+        --segment everything goes in one document.
+
+        Each segment is a list of (dive, surfaceinterval,
+        repetitiongroup_id), where repetitiongroup_id is set for the
+        dives that start a new <repetitiongroup>. The segments are
+        planned up front by plan_segments, the dives read as they're
+        needed.
+        """
+        dives = self.db.dives(orderby='datetime', selection=self.selection)
+        for plan in self.plan_segments():
+            # Same order as the timeline, so the plan comes first not to drop a dive.
+            yield [(dive, surfaceinterval, repititiongroup_id)
+                   for (dive_id, surfaceinterval, repititiongroup_id), dive in izip(plan, dives)]
 
 
-    def iter_dives(self):
+    def _segment_dive_ids(self, segment):
         """
-        Add all known dives to the UDDF document. The is the main
-        place to iterate across all dives and accumulate info.
+        The ids of the dives in segment, or None if it has all the selected ones.
         """
-        gasdefinitions = self._add(self.doc, 'gasdefinitions')
-        profiledata = self._add(self.doc, 'profiledata')
-        previous_divetime = datetime.min
-        repititiongroup_counter = 1
+        if not self.options.segment_size:
+            return None
+        return [dive.dive_id for dive, surfaceinterval, repititiongroup_id in segment]
 
-        dive_trips = []
-        segment_size = 0
-        for dive in self.db.dives(numbers=self.args, orderby='datetime'):
-            # Compute the SI and start a new group if INF
-            divetime = datetime.strptime(dive.dive_datetime, '%Y-%m-%d %H:%M:%S')
-            surfaceinterval = divetime - previous_divetime
 
-            if surfaceinterval >= SI_INF:
-                repititongroup = self._add(profiledata, 'repetitiongroup', attr={'id': _repgroup_ref(repititiongroup_counter)})
-                repititiongroup_counter += 1
+    def _segment_references(self, segment):
+        """
+        With --prune, the sites, buddies, equipment and tanks the
+        dives in segment refer to, see Logbook.references. Otherwise
+        None, every document has all of them.
+        """
+        if not self.options.prune_references:
+            return None
+        return self.db.references([dive.dive_id for dive, surfaceinterval, repititiongroup_id in segment])
 
-            self._add_gasdefinitions(gasdefinitions, dive)
-            self._add_dive(repititongroup, surfaceinterval, dive, dive_trips)
 
-            previous_divetime = divetime
+    def _build_segment(self, segment):
+        """
+        Build the minidom document for a segment.
+        """
+        self._start_new_doc(self._segment_references(segment))
+        self._add_gasdefinitions(self._segment_dive_ids(segment))
+        trips = self._segment_trips(segment)
+        profiledata = self._add(self.doc, 'profiledata')
+        contexts = self.db.dive_contexts([dive for dive, surfaceinterval, repititiongroup_id in segment])
+        for (dive, surfaceinterval, repititiongroup_id), context in izip(segment, contexts):
+            if self.instrument.enabled:
+                start = time.time()
+            if repititiongroup_id is not None:
+                repititongroup = self._add(profiledata, 'repetitiongroup', attr={'id': _repgroup_ref(repititiongroup_id)})
+            if self.dive_cache is not None:
+                # Rendered, or taken from the cache, and timed when it's written.
+                repititongroup.appendChild(_CachedDive(self, surfaceinterval, context))
+            else:
+                dive_group, mix_switch_times = self._add_dive(repititongroup, surfaceinterval, context)
+                sample_group = self._add(dive_group, 'samples')
+                if context.samples:
+                    sample_group.appendChild(self._waypoints(context, mix_switch_times))
+                if self.instrument.enabled:
+                    self.instrument.dive(dive.dive_id, time.time() - start)
+        self._add_divetrips(trips)
+        return self.top
 
-            segment_size += 1
-            #print 'SEGMENTS', segment_size, self.options.segment_size, surfaceinterval, SI_INF
-            if self.options.segment_size:
-                if surfaceinterval >= SI_INF and segment_size > int(self.options.segment_size):
-                    self._add_divetrips(dive_trips)
-                    yield self.top
 
-                    # Reset everything
-                    self._start_new_doc()
-                    gasdefinitions = self._add(self.doc, 'gasdefinitions')
-                    profiledata = self._add(self.doc, 'profiledata')
-                    segment_size = 0
-                    dive_trips = []
+    def _write_segment(self, out, segment, encoding):
+        """
+        Write the document for a segment to the XMLStreamWriter out as
+        it is generated. Only the header sections and a single dive at a
+        time are built as minidom nodes, and the waypoints of a dive are
+        written as one block.
+        """
+        self._start_new_doc(self._segment_references(segment))
+        out.start_document(encoding)
+        out.start('uddf', attr=_UDDF_ATTR)
+        for node in self.doc.childNodes:
+            out.node(node)
+
+        out.node(self._add_gasdefinitions(self._segment_dive_ids(segment)))
+
+        # Scratch element to hang the nodes off while they're written.
+        scratch = self.top.createElement('scratch')
+
+        trips = self._segment_trips(segment)
+        out.start('profiledata')
+        in_repititiongroup = False
+        contexts = self.db.dive_contexts([dive for dive, surfaceinterval, repititiongroup_id in segment])
+        for (dive, surfaceinterval, repititiongroup_id), context in izip(segment, contexts):
+            if self.instrument.enabled:
+                start = time.time()
+            if repititiongroup_id is not None:
+                if in_repititiongroup:
+                    out.end()
+                in_repititiongroup = True
+                out.start('repetitiongroup', attr={'id': _repgroup_ref(repititiongroup_id)})
+            if self.dive_cache is not None:
+                out.node(_CachedDive(self, surfaceinterval, context))
+            else:
+                dive_group, mix_switch_times = self._add_dive(scratch, surfaceinterval, context)
+                scratch.removeChild(dive_group)
+                out.start('dive', attr={'id': _dive_ref(dive.dive_id)})
+                for node in dive_group.childNodes:
+                    out.node(node)
+                dive_group.unlink()
+                out.start('samples')
+                if context.samples:
+                    out.node(self._waypoints(context, mix_switch_times))
+                out.end()
+                out.end()
+                if self.instrument.enabled:
+                    self.instrument.dive(dive.dive_id, time.time() - start)
+        if in_repititiongroup:
+            out.end()
+        out.end()
+
+        divetrips = self._add_divetrips(trips)
+        if divetrips:
+            out.node(divetrips)
+        out.close()
 
-        self._add_divetrips(dive_trips)
-        yield self.top
 
+    def iter_dives(self):
+        """
+        Add all known dives to the UDDF document. The is the main
+        place to iterate across all dives and accumulate info.
 
+        Yields a minidom document per segment, or with --stream an
+        object with the same writexml that generates the document as
+        it is written.
+        """
+        for segment in self._iter_segments():
+            yield self._segment_doc(segment)
 
 
+    def _segment_doc(self, segment):
+        if self.options.stream:
+            return _UDDFSegment(self, segment)
+        return self._build_segment(segment)
 
 
+    def plan_segments(self):
+        """
+        Plan the documents iter_dives would make without building them.
+
+        Returns a list of segments, each a list of (dive_id,
+        surfaceinterval, repetitiongroup_id) as for _iter_segments, see
+        Timeline.plan_segments. A segment can be handed to
+        export_segment, in this or in another process.
+        """
+        return self.timeline.plan_segments(int(self.options.segment_size or 0))
+
+
+    def export_segment(self, plan):
+        """
+        Returns the document for a segment from plan_segments, the same
+        as the one iter_dives yields for it.
+        """
+        dives = {}
+        if plan:
+            dives = dict((dive.dive_id, dive) for dive in self.db.dives(ids=[dive_id for dive_id, surfaceinterval, repititiongroup_id in plan]))
+        return self._segment_doc([(dives[dive_id], surfaceinterval, repititiongroup_id) for dive_id, surfaceinterval, repititiongroup_id in plan])
@@ -0,0 +1,115 @@
+"""
+Incremental XML writer that produces the same bytes as xml.dom.minidom
+"""
+
+import codecs
+
+from gdivelog.instrument import NULL_INSTRUMENTATION
+
+
+__all__ = ['XMLStreamWriter', 'escape', 'write_doc']
+__author__ = "Eskil Heyn <eskil@eskil.org>"
+__maintainer__ = "Eskil Olsen <eskil@eskil.org>"
+__copyright__ = "Copyright 2011"
+__license__ = "Public Domain"
+__version__ = "1.0"
+__status__ = "Production"
+
+
+def escape(data):
+    '''Escape character data the same way minidom does'''
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def write_doc(out, doc, prettyprint, instrument=NULL_INSTRUMENTATION):
+    """
+    Write doc to out, same as writing doc.toxml('utf-8') or
+    doc.toprettyxml(encoding='utf-8') but without making the string.
+    """
+    if instrument.enabled:
+        out = instrument.counting(out)
+    writer = codecs.getwriter('utf-8')(out)
+    if prettyprint:
+        doc.writexml(writer, '', '\t', '\n', 'utf-8')
+    else:
+        doc.writexml(writer, '', '', '', 'utf-8')
+
+
+class XMLStreamWriter(object):
+    """
+    Writes an XML document to a stream one element at a time.
+
+    Container elements are opened and closed with start/end, complete
+    subtrees (minidom nodes) are written with node. The output is
+    identical to what minidom's writexml gives for the same tree,
+    pretty printed or not, but only the stack of currently open
+    elements is kept around.
+    """
+
+    def __init__(self, writer, indent='', addindent='', newl=''):
+        """
+        Args;
+           writer -- file like object to write to, the same one minidom's writexml takes.
+           indent, addindent, newl -- as for minidom's writexml.
+        """
+        self.writer = writer
+        self.indent = indent
+        self.addindent = addindent
+        self.newl = newl
+        # [tag, has_children] for each open element. The start tag is
+        # left unterminated until we know if it's going to be <tag/>.
+        self.stack = []
+
+
+    def _current_indent(self):
+        return self.indent + self.addindent * len(self.stack)
+
+
+    def _begin_child(self):
+        '''Terminate the parent's start tag if this is its first child'''
+        if self.stack and not self.stack[-1][1]:
+            self.writer.write('>' + self.newl)
+            self.stack[-1][1] = True
+
+
+    def start_document(self, encoding=None):
+        '''Write the <?xml ...?> declaration'''
+        if encoding is None:
+            self.writer.write('<?xml version="1.0" ?>' + self.newl)
+        else:
+            self.writer.write('<?xml version="1.0" encoding="%s"?>%s' % (encoding, self.newl))
+
+
+    def start(self, tag, attr={}):
+        """
+        Open an element. Attribute values are formatted like xml_add does.
+        """
+        self._begin_child()
+        self.writer.write(self._current_indent() + '<' + tag)
+        for k in sorted(attr):
+            v = attr[k]
+            if not isinstance(v, basestring):
+                v = '%r' % v
+            self.writer.write(' %s="%s"' % (k, escape('%s' % v)))
+        self.stack.append([tag, False])
+
+
+    def end(self):
+        '''Close the most recently opened element'''
+        tag, has_children = self.stack.pop()
+        if has_children:
+            self.writer.write('%s</%s>%s' % (self._current_indent(), tag, self.newl))
+        else:
+            self.writer.write('/>' + self.newl)
+
+
+    def node(self, node):
+        '''Write a complete minidom node as a child of the current element'''
+        self._begin_child()
+        node.writexml(self.writer, self._current_indent(), self.addindent, self.newl)
+
+
+    def close(self):
+        '''Close all open elements'''
+        while self.stack:
+            self.end()
@@ -7,20 +7,24 @@ Convert gdivelog database to UDDF.
 
 Requires:
 
- * SQLAlchemy (http://www.sqlalchemy.org/)
+ * SQLAlchemy (http://www.sqlalchemy.org/) for --backend sqlalchemy
 
 """
 
 import sys
+import copy
 import os.path
-from datetime import datetime, timedelta
 from optparse import OptionParser
-import xml.dom.minidom
-from gdivelog.db import GDiveLogDB
-from gdivelog.db import GDiveLogDB
+from gdivelog.logbook import BACKENDS, open_logbook
 from gdivelog.prefs import GDiveLogPreferences
-from gdivelog.uddf import GDiveLogUDDF
-from gdivelog.udcf import GDiveLogUDCF
+from gdivelog.selection import Selection
+from gdivelog.instrument import Instrumentation, NULL_INSTRUMENTATION
+from gdivelog.writer import write_doc
+from gdivelog.compress import COMPRESSIONS, CompressedFile, check_compression, compression_for, open_output
+
+# The output formats, the database backends (see open_logbook) and
+# what's only needed for --jobs and --since-manifest are imported when
+# used, so exporting a few dives starts fast.
 
 __author__ = "Eskil Heyn <eskil@eskil.org>"
 __maintainer__ = "Eskil Olsen <eskil@eskil.org>"
@@ -31,50 +35,357 @@ __status__ = "Production"
 
 
 def sequence_file_name(fname, idx):
-    """Inject .N after the last dot"""
+    """Inject .N after the last dot, or before a compression extension like .uddf.gz"""
     path = fname.split('.')
+    extensions = 1
+    if len(path) > 2 and compression_for(fname):
+        extensions = 2
     if len(path) > 1:
-        return '.'.join(path[:-1] + ['%d' % idx, path[-1]])
+        return '.'.join(path[:-extensions] + ['%d' % idx] + path[-extensions:])
     return fname + '.%d' % idx
 
 
+def output_file_name(options, idx):
+    """
+    The file to write document idx to for --output, with the
+    --compress extension added if it's missing.
+    """
+    fname = sequence_file_name(options.output, idx)
+    if options.compress and compression_for(fname) != options.compress:
+        fname += '.' + options.compress
+    return fname
+
+
+def open_document(options, idx):
+    """
+    Open the output for document idx, --output or stdout, compressed
+    if --compress is given. Close it with close_document.
+    """
+    if options.output:
+        out = open_output(output_file_name(options, idx), options.compress)
+    elif options.compress:
+        out = CompressedFile(sys.stdout, options.compress, close_out=False)
+    else:
+        return sys.stdout
+    if options.compress and options.compress_thread:
+        from gdivelog.pipeline import ThreadedOutput
+        out = ThreadedOutput(out)
+    return out
+
+
+def close_document(out):
+    if out is not sys.stdout:
+        out.close()
+
+
+def _write_segment(xml, options, idx, plan, instrument=NULL_INSTRUMENTATION):
+    out = open_document(options, idx)
+    with instrument.stage('build'):
+        doc = xml.export_segment(plan)
+    with instrument.stage('write'):
+        write_doc(out, doc, options.prettyprint, instrument)
+    close_document(out)
+
+
+def make_instrumentation(options):
+    """
+    The Instrumentation for the --profile-* options, or
+    NULL_INSTRUMENTATION if none are given.
+    """
+    if options.profile_report or options.profile_json or options.profile_stage:
+        return Instrumentation(options.profile_stage)
+    return NULL_INSTRUMENTATION
+
+
+def report(xmls, options, instrument):
+    for xml in xmls:
+        if xml.simplifier:
+            print >> sys.stderr, xml.simplifier.report()
+    if options.profile_report:
+        instrument.report()
+    if options.profile_json:
+        instrument.write_json(options.profile_json)
+    if options.profile_stage:
+        instrument.write_profile(options.profile_output)
+
+
+def _export_segment(job):
+    """
+    Pool worker for --jobs, writes a planned segment to its file using
+    its own connection to the decompressed database. Returns the
+    simplifier counts and the instrumentation data for the report,
+    either None if not used.
+
+    With --profile-stage each worker profiles its own stage, but only
+    the main process' profile is written.
+    """
+    options, preferences, args, filename, idx, plan = job
+    from gdivelog.uddf import GDiveLogUDDF
+    instrument = make_instrumentation(options)
+    db = open_logbook(options, preferences, filename=filename, instrument=instrument)
+    xml = GDiveLogUDDF(db, options, preferences, args, instrument=instrument)
+    _write_segment(xml, options, idx, plan, instrument)
+    counts = data = None
+    if xml.simplifier:
+        counts = xml.simplifier.samples_in, xml.simplifier.samples_out
+    if instrument.enabled:
+        data = instrument.data()
+    return counts, data
+
+
+def export_segments(options, args, preferences, db, xml, instrument=NULL_INSTRUMENTATION):
+    """
+    Plan the UDDF segments up front and write them, for --jobs and
+    --since-manifest. With --since-manifest only the segments that
+    changed since the last export are written.
+    """
+    import multiprocessing
+    from gdivelog.manifest import Manifest
+
+    with instrument.stage('plan'):
+        plans = list(enumerate(xml.plan_segments()))
+        fnames = [output_file_name(options, idx) for idx, plan in plans]
+
+        if options.since_manifest:
+            manifest = Manifest(options.since_manifest)
+            fingerprints = manifest.fingerprint_segments(db, preferences, options, [plan for idx, plan in plans])
+            changed = [(idx, plan) for idx, plan in plans if manifest.changed(idx, fnames[idx], fingerprints[idx])]
+            if options.verbose:
+                print >> sys.stderr, '%d of %d segments changed' % (len(changed), len(plans))
+            plans = changed
+
+    if options.jobs > 1:
+        jobs = [(options, preferences, args, db.filename, idx, plan) for idx, plan in plans]
+        pool = multiprocessing.Pool(options.jobs)
+        for counts, data in pool.imap_unordered(_export_segment, jobs):
+            if counts:
+                xml.simplifier.add_counts(*counts)
+            if data:
+                instrument.merge(data)
+        pool.close()
+        pool.join()
+    else:
+        for idx, plan in plans:
+            _write_segment(xml, options, idx, plan, instrument)
+
+    if options.since_manifest:
+        manifest.update(fnames, fingerprints)
+        manifest.save()
+    report([xml], options, instrument)
+
+
+SINK_FORMATS = ('uddf', 'udcf')
+
+
+def parse_sinks(sinks):
+    """
+    Returns [(format, [destination, ...])] for the --sink values, in
+    the order each format is first given. Raises ValueError for a bad
+    one, or for two writing to the same place, since their threads
+    would mix up the documents.
+    """
+    formats = []
+    destinations = {}
+    seen = {}
+    for sink in sinks:
+        format, sep, destination = sink.partition(':')
+        if format not in SINK_FORMATS or not destination:
+            raise ValueError('Bad --sink %r, use FORMAT:FILE or FORMAT:- where FORMAT is %s' % (sink, ' or '.join(SINK_FORMATS)))
+        key = destination if destination == '-' else os.path.realpath(destination)
+        if key in seen:
+            raise ValueError('--sink %r and --sink %r write to the same place' % (seen[key], sink))
+        seen[key] = sink
+        if format not in destinations:
+            formats.append(format)
+            destinations[format] = []
+        destinations[format].append(destination)
+    return [(format, destinations[format]) for format in formats]
+
+
+def _sink_opener(destination):
+    '''The opener for a Sink writing to destination, see --sink'''
+    def opener(idx):
+        if destination == '-':
+            return sys.stdout
+        return open_output(sequence_file_name(destination, idx))
+    return opener
+
+
+def export_sinks(options, args, preferences, db, instrument=NULL_INSTRUMENTATION):
+    """
+    Generate each format given with --sink once, writing it to all of
+    that format's destinations through a FanOut while it's generated.
+
+    Each format is generated in a thread of its own with its own
+    connection to the decompressed database.
+    """
+    from gdivelog.pipeline import Sink, FanOut, run_threads
+    from gdivelog.uddf import GDiveLogUDDF
+    from gdivelog.udcf import GDiveLogUDCF
+
+    xmls = []
+    def producer(format, destinations, logbook):
+        format_options = copy.copy(options)
+        format_options.udcf = format == 'udcf'
+        # Same output, but written as it's generated instead of built first.
+        format_options.stream = True
+        if format_options.udcf:
+            xml = GDiveLogUDCF(logbook, format_options, preferences, args)
+        else:
+            xml = GDiveLogUDDF(logbook, format_options, preferences, args)
+        xmls.append(xml)
+
+        sinks = [Sink('%s:%s' % (format, destination), _sink_opener(destination)) for destination in destinations]
+        for sink in sinks:
+            sink.start()
+        out = FanOut(sinks)
+        try:
+            for idx, doc in enumerate(xml.iter_dives()):
+                out.start_document(idx)
+                write_doc(out, doc, options.prettyprint)
+                out.end_document()
+        finally:
+            out.close()
+            logbook.release()
+
+    producers = []
+    for format, destinations in parse_sinks(options.sinks):
+        logbook = db
+        if producers:
+            logbook = open_logbook(options, preferences, filename=db.filename)
+        producers.append(lambda format=format, destinations=destinations, logbook=logbook: producer(format, destinations, logbook))
+    with instrument.stage('write'):
+        run_threads(producers)
+    report(xmls, options, instrument)
+
 
 def main(options, args):
-    preferences = GDiveLogPreferences(options)
-    db = GDiveLogDB(options, preferences)
+    instrument = make_instrumentation(options)
+    with instrument.stage('open'):
+        preferences = GDiveLogPreferences(options)
+        db = open_logbook(options, preferences, instrument=instrument)
+
+    if options.sinks:
+        export_sinks(options, args, preferences, db, instrument)
+        return
 
     if options.udcf:
-        xml = GDiveLogUDCF(db, options, preferences, args)
+        from gdivelog.udcf import GDiveLogUDCF
+        xml = GDiveLogUDCF(db, options, preferences, args, instrument=instrument)
     else:
-        xml = GDiveLogUDDF(db, options, preferences, args)
+        from gdivelog.uddf import GDiveLogUDDF
+        xml = GDiveLogUDDF(db, options, preferences, args, instrument=instrument)
+        if options.verbose:
+            with instrument.stage('plan'):
+                print >> sys.stderr, xml.timeline.summary(int(options.segment_size or 0), options.trip_si_threshold)
 
-    for idx, doc in enumerate(xml.iter_dives()):
-        if options.output:
-            out = open(sequence_file_name(options.output, idx), 'w')
-        else:
-            out = sys.stdout
+    if not options.udcf and (options.jobs > 1 or options.since_manifest):
+        export_segments(options, args, preferences, db, xml, instrument)
+        return
 
-        if options.prettyprint:
-            out.write(doc.toprettyxml(encoding='utf-8'))
-        else:
-            out.write(doc.toxml('utf-8'))
+    docs = enumerate(xml.iter_dives())
+    while True:
+        with instrument.stage('build'):
+            try:
+                idx, doc = docs.next()
+            except StopIteration:
+                break
+        out = open_document(options, idx)
+        with instrument.stage('write'):
+            write_doc(out, doc, options.prettyprint, instrument)
+        close_document(out)
+    report([xml], options, instrument)
 
 
-if __name__ == '__main__':
+def cache_dir(name):
+    '''The directory name in $XDG_CACHE_HOME/gdivelog2uddf, or ~/.cache/gdivelog2uddf without it'''
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'gdivelog2uddf', name)
+
+
+def make_parser():
+    """
+    The command line options, also used by the benchmarks for the defaults.
+    """
     parser = OptionParser()
     parser.add_option('-d', '--dir', dest='gdivelog_dir', default=os.path.expanduser('~/.gdivelog'),
                       help='Directory with gdivelog "lastopened" and "preferences"')
     parser.add_option('-i', '--input', dest='gdivelog_db', metavar='FILE', default=None, help='gdivelog log file')
     parser.add_option('-c', '--config', dest='gdivelog_preferences', default=None, help='gdivelog preferences file')
+    parser.add_option('--db-cache-dir', dest='db_cache_dir', default=cache_dir('logbooks'),
+                      help='Directory to keep decompressed log files in, so unchanged logs are not decompressed again. Processes can share it, eg. in /dev/shm [default: %default, from $XDG_CACHE_HOME or ~/.cache]')
+    parser.add_option('--db-cache-size', dest='db_cache_size', type='int', default=1024, help='Max size of the decompressed log cache in MB')
+    parser.add_option('--no-db-cache', action='store_const', const=None, dest='db_cache_dir', help='Decompress the log file into a temporary file every time')
+    parser.add_option('--dive-cache-dir', dest='dive_cache_dir', default=cache_dir('dives'),
+                      help='Directory to keep the rendered UDDF <dive> elements in, so dives that have not changed are not rendered again [default: %default, from $XDG_CACHE_HOME or ~/.cache]')
+    parser.add_option('--dive-cache-size', dest='dive_cache_size', type='int', default=256, help='Max size of the rendered dive cache in MB')
+    parser.add_option('--no-cache', action='store_const', const=None, dest='dive_cache_dir', help='Render every dive instead of using the rendered dive cache')
+    parser.add_option('--backend', dest='backend', type='choice', choices=sorted(BACKENDS), default='sqlite',
+                      help='Read the log file with plain sqlite3 (sqlite) or the SQLAlchemy ORM (sqlalchemy), which is slower to import and query. Output is the same [default: %default]')
 
     parser.add_option('-p', '--pretty-print', '--pretty', '--prettyprint', action='store_true', dest='prettyprint', default=False, help='pretty print xml')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False,  help='print status messages to stdout')
     parser.add_option('--udcf', action='store_true', dest='udcf', default=False, help='dump dives as udcf')
+    parser.add_option('--select', dest='select', metavar='EXPR', default=None,
+                      help='Only export the dives matching EXPR, terms like date=2011-07..2011-09 number=100..199,250 site=Egypt buddy=Bob depth>30 duration<45m that all have to match. Combines with dive numbers given as arguments')
     parser.add_option('-o', '--output', dest='output', default=None, help='Output filename. Must be set if using --segment')
     parser.add_option('--trip-threshold', dest='trip_si_threshold', type='int', default=None, help='Dives within this number of days are grouped into 1 trip')
-    parser.add_option('--segment', dest='segment_size', default=None, help='To reduce memory usage, batch output into files with this number of dives per segment (number will be varied since trips will not be split')
+    parser.add_option('--segment', dest='segment_size', default=None, help='To reduce memory usage, batch output into files with this number of dives per segment (number will be varied since trips and repetitive dives will not be split')
+    parser.add_option('--prune', action='store_true', dest='prune_references', default=False,
+                      help='Only include the sites, buddies, equipment and tanks the dives of each UDDF document refer to, instead of all of them in every segment')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='Write this many UDDF segments in parallel. Requires --output')
+    parser.add_option('--since-manifest', dest='since_manifest', metavar='FILE', default=None,
+                      help='Only write the UDDF segments that changed since the export that wrote this manifest, then update it. Requires --output')
+    parser.add_option('--max-samples', dest='max_samples', type='int', default=None,
+                      help='Simplify each dive profile down to at most this many samples. Max depth, temperature extremes and mix switches are always kept')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=None,
+                      help='Simplify each dive profile, dropping samples while the profile changes less than this depth')
+    parser.add_option('--stream', action='store_true', dest='stream', default=False, help='Write dives as they are generated instead of building the whole document first. Output is the same, memory usage is flat')
+    parser.add_option('--compress', dest='compress', type='choice', choices=list(COMPRESSIONS), default=None,
+                      help='Compress the output with gz, bz2 or xz (needs backports.lzma) as it is written. Default is what the --output extension says, eg. dives.uddf.gz')
+    parser.add_option('--compress-thread', action='store_true', dest='compress_thread', default=False,
+                      help='Compress in a background thread, overlapping with generating the output')
+    parser.add_option('--sink', dest='sinks', metavar='FORMAT:FILE', action='append', default=[],
+                      help='Write FORMAT (uddf or udcf) to FILE (numbered like --output, compressed if it ends in .gz, .bz2 or .xz, or - for stdout). May be repeated, each format is generated once for all its sinks and the formats are generated concurrently')
+    parser.add_option('--serve', dest='serve', metavar='ADDRESS', default=None,
+                      help='Keep the log file open and serve exports over HTTP on ADDRESS, a Unix socket path or [host:]port, reloading when the log file changes. GET /export?dives=1,2&select=EXPR&format=uddf|udcf&segment=N&part=I&pretty=1')
+    parser.add_option('--profile-report', action='store_true', dest='profile_report', default=False,
+                      help='Print the time and peak memory of each stage, query/row/node/byte counts and the slowest dives to stderr. With --stream the dives are built in the write stage')
+    parser.add_option('--profile-json', dest='profile_json', metavar='FILE', default=None, help='Write the --profile-report numbers to FILE as JSON')
+    parser.add_option('--profile-stage', dest='profile_stage', default=None, type='choice', choices=['open', 'plan', 'build', 'write'],
+                      help='Run cProfile over this stage (open, plan, build or write) and write the stats to --profile-output')
+    parser.add_option('--profile-output', dest='profile_output', metavar='FILE', default='gdivelog2uddf.prof', help='File for the --profile-stage stats, for pstats [default: %default]')
+    return parser
 
+
+if __name__ == '__main__':
+    parser = make_parser()
     (options, args) = parser.parse_args()
+    if options.jobs > 1 and not options.output:
+        parser.error('--jobs requires --output')
+    if options.since_manifest and not options.output:
+        parser.error('--since-manifest requires --output')
+    if options.sinks:
+        if options.output or options.udcf or options.jobs > 1 or options.since_manifest:
+            parser.error('--sink replaces --output and --udcf, and can\'t be used with --jobs or --since-manifest')
+        try:
+            parse_sinks(options.sinks)
+        except ValueError, e:
+            parser.error(str(e))
+
+    if options.compress is None and options.output:
+        options.compress = compression_for(options.output)
+    compressions = [options.compress] + [compression_for(sink) for sink in options.sinks]
+    for compression in set(compressions):
+        try:
+            check_compression(compression)
+        except ImportError, e:
+            parser.error(str(e))
+
+    if options.select or args:
+        try:
+            args = Selection(options.select, args)
+        except ValueError, e:
+            parser.error(str(e))
 
     if not options.gdivelog_preferences:
         options.gdivelog_preferences = options.gdivelog_dir + '/preferences'
@@ -83,4 +394,8 @@ if __name__ == '__main__':
         lastopened = open(options.gdivelog_dir + '/lastopened', 'r')
         options.gdivelog_db = lastopened.read()
 
-    main(options, args)
+    if options.serve:
+        from gdivelog.server import serve
+        serve(options)
+    else:
+        main(options, args)